@@ -0,0 +1,366 @@
+# =========================================================
+# PureMuse Telegram Bot – modo ASGI
+# ---------------------------------------------------------
+# Mismas rutas que bot.app, pero /telegram y /mp/webhook corren
+# en un event loop: httpx async hacia Telegram/Mercado Pago y
+# SQLAlchemy async (asyncpg) hacia Postgres. Un solo proceso
+# atiende cientos de updates concurrentes en vez de 8 hilos.
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+#
+# El resto de rutas (admin, cron, métricas) se sirven con la
+# app Flask montada detrás, en el threadpool.
+# =========================================================
+import os
+import asyncio
+import time
+import traceback
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import delete, event, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+
+import bot
+from bot import (
+    PERF, CRON_TOKEN, TOKEN, VIPUser, VIPRecord, StaticReply, _MISS, catalog, esc, is_active,
+)
+
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "10"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "100"))
+
+
+def async_database_url(url: str):
+    """Convierte DATABASE_URL al driver async equivalente (asyncpg / aiosqlite) y sus opciones de pool."""
+    u = make_url(url)
+    connect_args, pool = {}, {}
+    if u.get_backend_name() == "postgresql":
+        query = dict(u.query)
+        sslmode = query.pop("sslmode", None)
+        query.pop("channel_binding", None)  # Neon lo agrega; asyncpg no lo acepta
+        if sslmode and sslmode != "disable":
+            connect_args["ssl"] = "require"
+        u = u.set(drivername="postgresql+asyncpg", query=query)
+        if bot.DB_PGBOUNCER:
+            # PgBouncer en modo transaction no conserva prepared statements entre transacciones
+            connect_args.update(statement_cache_size=0, prepared_statement_cache_size=0)
+            pool = {"poolclass": NullPool}
+        else:
+            pool = {"pool_size": ASYNC_POOL_SIZE, "max_overflow": bot.DB_MAX_OVERFLOW,
+                    "pool_timeout": bot.DB_POOL_TIMEOUT, "pool_use_lifo": True}
+    elif u.get_backend_name() == "sqlite":
+        u = u.set(drivername="sqlite+aiosqlite")
+    return u, connect_args, pool
+
+
+_url, _connect_args, _pool_args = async_database_url(bot.DATABASE_URL)
+aengine = create_async_engine(_url, connect_args=_connect_args, pool_recycle=bot.DB_POOL_RECYCLE,
+                              pool_pre_ping=bot.DB_PRE_PING, future=True, **_pool_args)
+ASession = async_sessionmaker(aengine, expire_on_commit=False)
+
+# Mismo contador/tiempos de queries que el engine sync
+event.listen(aengine.sync_engine, "before_cursor_execute", bot._count_db_query)
+event.listen(aengine.sync_engine, "after_cursor_execute", bot._time_db_query)
+event.listen(aengine.sync_engine, "handle_error", bot._time_db_error)
+
+http: Optional[httpx.AsyncClient] = None
+_tasks: set = set()
+_link_inflight: dict[int, asyncio.Future] = {}
+_chat_locks: dict[int, asyncio.Lock] = {}
+
+
+def spawn(coro):
+    """Lanza una tarea en segundo plano y guarda la referencia hasta que termine."""
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+# ========= Telegram =========
+async def tg_post_async(chat_id: int, body: bytes):
+    """Igual que bot._tg_post, con los mismos token buckets, sin bloquear el loop."""
+    for _ in range(bot.TG_MAX_RETRIES + 1):
+        pause = bot._tg_paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        wait = max(bot._tg_chat_bucket(chat_id).reserve(), bot._tg_global_bucket.reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            with PERF.track("outbound", target="tg_send") as t:
+                r = await http.post(bot.TG_SEND_URL, content=body, headers=bot.JSON_HEADERS, timeout=15)
+                t.error = r.status_code >= 400
+        except Exception as e:
+            print("⚠️ Telegram send exception:", e)
+            return
+        if r.status_code != 429:
+            if r.status_code >= 400:
+                print("⚠️ Telegram send error:", r.status_code, r.text[:200])
+            return
+        PERF.inc("tg_rate_limited", {})
+        try:
+            retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            retry_after = 1.0
+        bot._tg_paused_until = max(bot._tg_paused_until, time.monotonic() + retry_after)
+    print("⚠️ Telegram send dropped after retries:", chat_id)
+
+
+def tg_send(chat_id: int, text, preview=False, kb=True):
+    if not TOKEN:
+        return
+    tail = text.tail if isinstance(text, StaticReply) else bot.payload_tail(text, preview, kb)
+    spawn(tg_post_async(chat_id, bot.tg_body(chat_id, tail)))
+
+
+# ========= Mercado Pago =========
+async def mp_create_link_async(chat_id: int) -> str:
+    """Como bot.mp_create_link: misma caché y una sola llamada por chat a la vez."""
+    link = bot._mp_link_cache.get(chat_id)
+    if link is not _MISS:
+        PERF.inc("mp_link_cache", {"result": "hit"})
+        return link
+    PERF.inc("mp_link_cache", {"result": "miss"})
+    fut = _link_inflight.get(chat_id)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = _link_inflight[chat_id] = asyncio.get_running_loop().create_future()
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # evita "exception never retrieved"
+    try:
+        headers, data = bot.mp_preference_request(chat_id)
+        with PERF.track("outbound", target="mp_create_link"):
+            r = await http.post(bot.MP_PREFS_URL, headers=headers, json=data, timeout=20)
+            r.raise_for_status()
+        payload = r.json()
+        link = payload.get("init_point") or payload.get("sandbox_init_point")
+        if link:
+            bot._mp_link_cache.set(chat_id, link)
+        fut.set_result(link)
+        return link
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        _link_inflight.pop(chat_id, None)
+
+
+# ========= DB =========
+async def ensure_schema():
+    if not bot._schema_ready:
+        await asyncio.to_thread(bot.ensure_schema_safe)
+
+
+async def vip_lookup_async(chat_id: int) -> Optional[VIPRecord]:
+    # vip_cache puede ser Redis (socket bloqueante): fuera del loop
+    rec = await asyncio.to_thread(bot.vip_cache.get, chat_id)
+    if rec is not _MISS:
+        return rec
+    async with ASession() as db:
+        row = (await db.execute(
+            select(VIPUser.chat_id, VIPUser.active_until, VIPUser.last_sent_at).where(VIPUser.chat_id == chat_id)
+        )).first()
+    rec = VIPRecord(*row) if row else None
+    await asyncio.to_thread(bot.vip_cache.set, chat_id, rec,
+                            ttl=bot.VIP_CACHE_TTL if rec else bot.VIP_CACHE_NEG_TTL)
+    return rec
+
+
+async def deliver_gallery_async(chat_id: int, free_gallery: str):
+    snap = await asyncio.to_thread(catalog.snapshot)  # puede hacer stat()/leer el archivo
+    if snap.version != bot._gallery_synced_version:
+        await asyncio.to_thread(bot.ensure_galleries_synced)
+    async with ASession() as db:
+        # La misma lógica que el modo sync, sobre la conexión async
+        status, url = await db.run_sync(bot.deliver_vip_gallery, chat_id)
+    await asyncio.to_thread(bot.vip_invalidate, chat_id)
+    return bot.gallery_reply(status, url, free_gallery)
+
+
+# ========= Handlers =========
+# Mismo router que bot.TG_ROUTES; las ramas con I/O tienen su versión async aquí.
+# Las demás (respuestas fijas) se usan tal cual, no tocan red ni DB.
+async def cmd_vip(chat_id: int):
+    return bot.vip_link_text(await mp_create_link_async(chat_id))
+
+
+async def cmd_vip_status(chat_id: int):
+    rec = await vip_lookup_async(chat_id)
+    return bot.vip_status_text(rec) if rec else bot.NO_VIP_REPLY
+
+
+async def cmd_galleries(chat_id: int):
+    free_gallery = await asyncio.to_thread(lambda: catalog.free)
+    if not free_gallery:
+        return bot.NO_GALLERIES_REPLY
+    rec = await vip_lookup_async(chat_id)
+    if not rec or not is_active(rec):
+        return bot.free_gallery_text(free_gallery)
+    if rec.last_sent_at and rec.last_sent_at.date() == bot.day_mx():
+        async with ASession() as db:
+            return bot.already_sent_text(await db.run_sync(bot.todays_gallery_url, chat_id))
+    return await deliver_gallery_async(chat_id, free_gallery)
+
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    """Como bot.chat_lock, para el event loop: updates del mismo chat de uno en uno."""
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        if len(_chat_locks) > 10000:
+            for k in [k for k, v in _chat_locks.items() if not v.locked()]:
+                del _chat_locks[k]
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+async def tg_dedupe(update_id: Optional[int], route: bot.TGRoute) -> Optional[str]:
+    """Misma lógica que bot.tg_dedupe; la guardia en DB va por la conexión async."""
+    if update_id is None:
+        return None
+    if not bot.recent_updates.add(update_id):
+        return "memory"
+    if route.static:
+        return None
+    async with ASession() as db:
+        claimed = await db.run_sync(bot.claim_update, update_id)
+        await db.commit()
+    return None if claimed else "db"
+
+
+async def release_update(update_id: int):
+    bot.recent_updates.discard(update_id)
+    async with ASession() as db:
+        await db.execute(delete(bot.ProcessedUpdate).where(bot.ProcessedUpdate.update_id == update_id))
+        await db.commit()
+
+
+ASYNC_HANDLERS = {"vip": cmd_vip, "vip_status": cmd_vip_status, "galleries": cmd_galleries}
+
+
+async def handle_message(chat_id: int, route: bot.TGRoute) -> Optional[bytes]:
+    handler = ASYNC_HANDLERS.get(route.branch)
+    async with chat_lock(chat_id):
+        reply = await handler(chat_id) if handler else route.handler(chat_id, None)
+    if reply is None:
+        return None
+    if bot.TG_WEBHOOK_REPLY and isinstance(reply, StaticReply):
+        return bot.tg_webhook_body(chat_id, reply.tail)
+    tg_send(chat_id, reply)
+    return None
+
+
+async def _json(request) -> dict:
+    try:
+        d = await request.json()
+    except Exception:
+        return {}
+    return d if isinstance(d, dict) else {}
+
+
+async def telegram_webhook(request):
+    t0 = time.perf_counter()
+    branch, error, body, update_id = "none", False, None, None
+    try:
+        await ensure_schema()
+        d = await _json(request)
+        chat_id, txt = bot.tg_message(d)
+        if chat_id:
+            route = bot.tg_match(txt)
+            branch = route.branch
+            update_id = d.get("update_id")
+            dup = await tg_dedupe(update_id, route)
+            if dup:
+                branch = "duplicate"
+                PERF.inc("tg_duplicate", {"layer": dup})
+            else:
+                body = await handle_message(chat_id, route)
+    except Exception as e:
+        error = True
+        err = traceback.format_exc()
+        if update_id is not None:
+            try:
+                await release_update(update_id)
+            except Exception as release_err:
+                print("⚠️ release_update error:", release_err)
+        await asyncio.to_thread(bot.recheck_schema_on, e)
+        tg_send(bot.OWNER_CHAT_ID, f"🔥 Telegram handler crashed:\n<pre>{esc(err)}</pre>", kb=False)
+    finally:
+        PERF.observe("http", {"route": "/telegram", "branch": branch}, time.perf_counter() - t0, error)
+        PERF.flush()
+        if time.monotonic() >= bot._updates_pruned_at:
+            spawn(asyncio.to_thread(bot.maybe_purge_processed_updates))
+    if body:
+        return Response(body, media_type="application/json")
+    return JSONResponse({"ok": True})
+
+
+async def mp_webhook(request):
+    if request.query_params.get("secret") != CRON_TOKEN:
+        return PlainTextResponse("forbidden", status_code=403)
+    t0 = time.perf_counter()
+    error = False
+    try:
+        await ensure_schema()
+        bot.mp_start_worker()
+        d = await _json(request)
+        pid = (d.get("data") or {}).get("id") or d.get("id")
+        if not pid:
+            return PlainTextResponse("missing id", status_code=400)
+        async with ASession() as db:
+            queued = await db.run_sync(bot.mp_inbox_record, str(pid))
+        if queued:
+            if bot.MP_WEBHOOK_MODE == "sync":
+                await asyncio.to_thread(bot.process_mp_notification, str(pid))
+            else:
+                await asyncio.to_thread(bot.mp_enqueue, str(pid))
+        return PlainTextResponse("ok")
+    except Exception as e:
+        error = True
+        await asyncio.to_thread(bot.recheck_schema_on, e)
+        traceback.print_exc()
+        return PlainTextResponse("error", status_code=500)  # MP reintentará
+    finally:
+        PERF.observe("http", {"route": "/mp/webhook"}, time.perf_counter() - t0, error)
+
+
+async def root(request):
+    return JSONResponse({"ok": True, "service": "PureMuse Bot v3.2", "mode": "asgi"})
+
+
+async def health(request):
+    return PlainTextResponse("ok")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=20)
+    http = httpx.AsyncClient(limits=limits, timeout=20)
+    await ensure_schema()
+    bot.mp_start_worker()  # su barrido recoge pagos pendientes aunque no lleguen avisos
+    try:
+        yield
+    finally:
+        if _tasks:
+            await asyncio.wait(list(_tasks), timeout=10)
+        await http.aclose()
+        await aengine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route("/", root),
+        Route("/health", health),
+        Route("/telegram", telegram_webhook, methods=["POST"]),
+        Route("/mp/webhook", mp_webhook, methods=["POST"]),
+        Mount("", app=WSGIMiddleware(bot.app)),
+    ],
+    lifespan=lifespan,
+)
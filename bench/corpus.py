@@ -0,0 +1,72 @@
+"""Corpus reproducibles (misma semilla → mismos datos) para repetir una carga.
+
+    python bench/corpus.py telegram -n 5000 --chats 500 -o /tmp/tg.jsonl
+    python bench/corpus.py mp -n 1000 --dup 0.3 -o /tmp/mp.jsonl
+
+Cada línea del archivo es un cuerpo JSON tal como lo mandaría Telegram o
+Mercado Pago al webhook correspondiente.
+"""
+import argparse
+import json
+import random
+from typing import Optional
+
+# Proporciones aproximadas de lo que escribe la gente en el bot
+TELEGRAM_MIX = {
+    "/start": 15, "Pure Muse": 10, "VIP": 10, "VIP status": 20, "Galleries": 35, "hola": 10,
+}
+
+
+def telegram_updates(n: int, chats: int, seed: int = 1, mix: Optional[dict] = None,
+                     first_update_id: int = 1) -> list[dict]:
+    rnd = random.Random(seed)
+    mix = mix or TELEGRAM_MIX
+    texts, weights = list(mix), list(mix.values())
+    return [
+        {"update_id": first_update_id + i,
+         "message": {"message_id": i + 1, "chat": {"id": rnd.randint(1, chats)},
+                     "text": rnd.choices(texts, weights)[0]}}
+        for i in range(n)
+    ]
+
+
+def mp_notifications(n: int, dup: float = 0.2, seed: int = 1, first_id: int = 1_000_000) -> list[dict]:
+    """Notificaciones de pago; una fracción `dup` repite un id anterior (MP reintenta mucho)."""
+    rnd = random.Random(seed)
+    out, ids = [], []
+    for _ in range(n):
+        if ids and rnd.random() < dup:
+            pid = rnd.choice(ids)
+        else:
+            pid = first_id + len(ids)
+            ids.append(pid)
+        out.append({"type": "payment", "action": "payment.updated", "data": {"id": str(pid)}})
+    return out
+
+
+def save(path: str, items: list[dict]):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in items:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
+def load(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Generate a replayable update corpus")
+    ap.add_argument("kind", choices=["telegram", "mp"])
+    ap.add_argument("-n", type=int, default=1000)
+    ap.add_argument("--chats", type=int, default=500)
+    ap.add_argument("--dup", type=float, default=0.2, help="mp: fraction of repeated payment ids")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("-o", "--out", required=True)
+    args = ap.parse_args()
+    if args.kind == "telegram":
+        items = telegram_updates(args.n, args.chats, args.seed)
+    else:
+        items = mp_notifications(args.n, args.dup, args.seed)
+    save(args.out, items)
+    print(f"wrote {len(items)} {args.kind} items to {args.out}")
@@ -0,0 +1,91 @@
+"""Carga concurrente sobre /telegram para comparar el modo WSGI con el ASGI.
+
+    # 1) stub de Telegram/Mercado Pago con latencia de red simulada
+    python bench/stubs.py --port 8081 --latency 0.15
+
+    # 2) los dos servidores, apuntando al stub y a la misma DB
+    export TG_API_BASE=http://127.0.0.1:8081 MP_API_BASE=http://127.0.0.1:8081
+    export TOKEN=x MP_ACCESS_TOKEN=x BASE_URL=http://localhost CRON_TOKEN=s DATABASE_URL=...
+    gunicorn bot:app -c gunicorn.conf.py -b 127.0.0.1:8000
+    uvicorn asgi:app --workers 2 --port 8001
+
+    # 3) la misma carga contra ambos (--corpus para repetir exactamente la misma)
+    python bench/load_webhook.py http://127.0.0.1:8000 http://127.0.0.1:8001 -n 2000 -c 200
+"""
+import argparse
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+
+from corpus import load, telegram_updates
+
+Req = tuple[str, str, Optional[dict]]  # (método, ruta, cuerpo JSON)
+
+
+def pct(sorted_vals: list[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+def summarize(name: str, latencies: list[float], errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": pct(latencies, 0.50) * 1000,
+        "p99_ms": pct(latencies, 0.99) * 1000,
+    }
+
+
+async def drive(base_url: str, reqs: list[Req], concurrency: int, name: str = "") -> dict:
+    """Manda `reqs` con `concurrency` clientes a la vez y resume latencias y errores."""
+    latencies: list[float] = []
+    errors = 0
+    it = iter(reqs)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for method, path, body in it:
+                t0 = time.perf_counter()
+                try:
+                    r = await client.request(method, path, json=body)
+                    if r.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+    return summarize(name or base_url, latencies, errors, elapsed)
+
+
+def print_table(rows: list[dict]):
+    print(f"{'scenario':<40} {'req':>6} {'err':>5} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for r in rows:
+        print(f"{r['name']:<40} {r['requests']:>6} {r['errors']:>5} {r['rps']:>9.1f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Load test for the /telegram webhook")
+    ap.add_argument("urls", nargs="+", help="base URL(s) of running servers")
+    ap.add_argument("-n", "--requests", type=int, default=1000)
+    ap.add_argument("-c", "--concurrency", type=int, default=100)
+    ap.add_argument("--chats", type=int, default=500, help="distinct chat ids in the corpus")
+    ap.add_argument("--corpus", help="JSONL file from bench/corpus.py instead of a generated one")
+    args = ap.parse_args()
+
+    updates = load(args.corpus) if args.corpus else telegram_updates(args.requests, args.chats)
+    reqs = [("POST", "/telegram", u) for u in updates]
+    print_table([asyncio.run(drive(url, reqs, args.concurrency)) for url in args.urls])
+
+
+if __name__ == "__main__":
+    main()
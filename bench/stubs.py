@@ -0,0 +1,138 @@
+"""Servidor local que imita a Telegram y Mercado Pago para benchmarks.
+
+    python bench/stubs.py --port 8081 --latency 0.15 --jitter 0.05 --rate-limit-every 50
+
+Luego arrancar el bot con TG_API_BASE=http://127.0.0.1:8081 y
+MP_API_BASE=http://127.0.0.1:8081 (y TOKEN / MP_ACCESS_TOKEN / BASE_URL
+con cualquier valor) para que todo el tráfico saliente quede en local.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    jitter = 0.0
+    rate_limit_every = 0  # cada N sendMessage, un 429 con retry_after (0 = nunca)
+    retry_after = 1.0
+    counts: dict = {}
+    lock = threading.Lock()
+    updates: list = []  # cola para getUpdates; se llena con POST /_updates
+    webhook = {"url": ""}  # como Telegram: con webhook puesto, getUpdates contesta 409
+
+    def _reply(self, code: int, body: dict):
+        raw = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _count(self, key: str) -> int:
+        with self.lock:
+            n = self.counts[key] = self.counts.get(key, 0) + 1
+            return n
+
+    def _wait(self):
+        time.sleep(self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0))
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(n) or b"{}")
+        except ValueError:
+            return {}
+
+    def do_POST(self):
+        body = self._body()
+        if self.path == "/_updates":
+            with self.lock:
+                self.updates.extend(body if isinstance(body, list) else [body])
+            return self._reply(200, {"ok": True})
+        body = body if isinstance(body, dict) else {}
+        self._wait()
+        if "/sendMessage" in self.path:
+            n = self._count("sendMessage")
+            if self.rate_limit_every and n % self.rate_limit_every == 0:
+                self._count("rate_limited")
+                return self._reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                         "parameters": {"retry_after": self.retry_after}})
+            return self._reply(200, {"ok": True, "result": {"message_id": 1, "chat": {"id": body.get("chat_id")}}})
+        if "/getUpdates" in self.path:
+            self._count("getUpdates")
+            if self.webhook["url"]:
+                return self._reply(409, {"ok": False, "error_code": 409,
+                                         "description": "Conflict: can't use getUpdates method while webhook is active"})
+            offset = int(body.get("offset") or 0)
+            with self.lock:
+                self.updates[:] = [u for u in self.updates if u["update_id"] >= offset]
+                batch = self.updates[: int(body.get("limit") or 100)]
+            return self._reply(200, {"ok": True, "result": batch})
+        if "/setWebhook" in self.path or "/deleteWebhook" in self.path:
+            self._count(self.path.rsplit("/", 1)[-1])
+            self.webhook["url"] = body.get("url", "") if "/setWebhook" in self.path else ""
+            return self._reply(200, {"ok": True, "result": True})
+        if "/getWebhookInfo" in self.path:
+            return self._reply(200, {"ok": True, "result": {"url": self.webhook["url"],
+                                                            "pending_update_count": len(self.updates)}})
+        if self.path.startswith("/checkout/preferences"):
+            self._count("preferences")
+            ref = body.get("external_reference", "0")
+            return self._reply(201, {"id": f"pref-{ref}", "init_point": f"https://mp.local/checkout/{ref}"})
+        self._reply(404, {"ok": False})
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            with self.lock:
+                return self._reply(200, dict(self.counts))
+        self._wait()
+        if self.path.startswith("/v1/payments/"):
+            self._count("payments")
+            pid = self.path.rsplit("/", 1)[-1]
+            return self._reply(200, {
+                "id": pid, "status": "approved", "transaction_amount": 50, "currency_id": "MXN",
+                "external_reference": str(int(pid) % 100000 + 1) if pid.isdigit() else "1",
+            })
+        self._reply(404, {"ok": False})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # el default (5) tira conexiones bajo carga
+
+
+def serve(port: int, latency: float = 0.0, host: str = "127.0.0.1", jitter: float = 0.0,
+          rate_limit_every: int = 0, retry_after: float = 1.0) -> ThreadingHTTPServer:
+    """Arranca el stub en un hilo y devuelve el servidor (server.shutdown() para pararlo)."""
+    handler = type("Handler", (StubHandler,), {
+        "latency": latency, "jitter": jitter, "rate_limit_every": rate_limit_every, "retry_after": retry_after,
+        "counts": {}, "lock": threading.Lock(), "updates": [], "webhook": {"url": ""},
+    })
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.15, help="segundos de espera por llamada")
+    ap.add_argument("--jitter", type=float, default=0.0, help="espera extra aleatoria, hasta N segundos")
+    ap.add_argument("--rate-limit-every", type=int, default=0, help="un 429 cada N sendMessage")
+    ap.add_argument("--retry-after", type=float, default=1.0)
+    args = ap.parse_args()
+    serve(args.port, args.latency, jitter=args.jitter, rate_limit_every=args.rate_limit_every,
+          retry_after=args.retry_after)
+    print(f"stub listening on http://127.0.0.1:{args.port} (latency {args.latency}s)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -8,23 +8,43 @@
 #  🔒 DB auto-repair and persistence
 #  💬 Owner alerts for any DB or API issue
 # =========================================================
+import io
 import os
+import csv
+import json
+import time
 import html
+import heapq
+import queue
 import hashlib
+import tempfile
+import threading
 import traceback
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Optional, Iterable
+from collections import Counter, OrderedDict, deque
+from typing import Callable, Optional, NamedTuple
 
+import click
 import requests
-from flask import Flask, request, jsonify
+try:
+    import redis  # opcional: caché compartida entre workers (VIP_CACHE_URL)
+except ImportError:
+    redis = None
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify, g, stream_with_context, has_request_context
 
 from sqlalchemy import (
-    create_engine, BigInteger, Integer, String, Date, DateTime,
-    UniqueConstraint, text, delete, select, func
+    create_engine, BigInteger, Integer, String, Date, DateTime, MetaData, Table, Column,
+    UniqueConstraint, text, delete, select, insert, update, exists, and_, or_, case, func, literal, tuple_
 )
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy.exc import ProgrammingError, OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.exc import ProgrammingError, OperationalError, IntegrityError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 # ========= ENV VARS =========
 TOKEN = os.getenv("TOKEN", "")
@@ -34,19 +54,453 @@ CRON_TOKEN = os.getenv("CRON_TOKEN", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 OWNER_CHAT_ID = 1703988973  # <— tu chat_id (notificaciones al dueño)
 
+# Cola de envíos a Telegram ("async" = workers en segundo plano, "sync" = en línea, útil en tests)
+TG_SEND_MODE = os.getenv("TG_SEND_MODE", "async").lower()
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "4"))
+TG_QUEUE_MAX = int(os.getenv("TG_QUEUE_MAX", "5000"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))  # límite de Telegram: ~30 msg/s por bot
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))       # ~1 msg/s por chat
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+# Contestar las respuestas fijas en el cuerpo del webhook (sin petición saliente)
+TG_WEBHOOK_REPLY = os.getenv("TG_WEBHOOK_REPLY", "1") == "1"
+
+# Webhook de Mercado Pago: "async" = se encola y responde al instante, "sync" = en línea
+MP_WEBHOOK_MODE = os.getenv("MP_WEBHOOK_MODE", "async").lower()
+MP_INBOX_SCAN_SECS = float(os.getenv("MP_INBOX_SCAN_SECS", "30"))
+MP_INBOX_MAX_ATTEMPTS = int(os.getenv("MP_INBOX_MAX_ATTEMPTS", "8"))
+
+# Modo long polling (flask --app bot poll): tamaño de lote y espera de getUpdates
+TG_POLL_LIMIT = min(100, int(os.getenv("TG_POLL_LIMIT", "100")))
+TG_POLL_TIMEOUT = int(os.getenv("TG_POLL_TIMEOUT", "25"))
+
+# Deduplicación de updates: ventana en memoria por proceso + tabla tg_updates (días que se guardan)
+TG_DEDUPE_WINDOW = int(os.getenv("TG_DEDUPE_WINDOW", "10000"))
+TG_DEDUPE_DAYS = int(os.getenv("TG_DEDUPE_DAYS", "2"))
+TG_DEDUPE_PRUNE_SECS = float(os.getenv("TG_DEDUPE_PRUNE_SECS", "3600"))  # cada cuánto borra cada proceso lo viejo de tg_updates
+
+MP_LINK_TTL = float(os.getenv("MP_LINK_TTL", "900"))  # segundos que se reutiliza el link de pago de un chat
+
+# Caché de estado VIP ("" = en memoria por worker, "redis://..." = compartida)
+VIP_CACHE_URL = os.getenv("VIP_CACHE_URL", "")
+VIP_CACHE_SIZE = int(os.getenv("VIP_CACHE_SIZE", "20000"))
+VIP_CACHE_TTL = float(os.getenv("VIP_CACHE_TTL", "60"))
+VIP_CACHE_NEG_TTL = float(os.getenv("VIP_CACHE_NEG_TTL", "10"))  # "no es VIP": corto, por si acaba de pagar
+
+DAILY_CHUNK = int(os.getenv("DAILY_CHUNK", "500"))
+DAILY_MAX_SECONDS = float(os.getenv("DAILY_MAX_SECONDS", "90"))  # < timeout de gunicorn
+
+# Barrido de vencimientos (/cron/expiration_sweep)
+EXPIRY_REMIND_DAYS = int(os.getenv("EXPIRY_REMIND_DAYS", "3"))       # aviso N días antes de vencer
+EXPIRY_NOTICE_DAYS = int(os.getenv("EXPIRY_NOTICE_DAYS", "7"))       # no avisar vencimientos más viejos que esto
+EXPIRY_ARCHIVE_DAYS = int(os.getenv("EXPIRY_ARCHIVE_DAYS", "0"))     # 0 = no archivar entregas
+EXPIRY_CHUNK = int(os.getenv("EXPIRY_CHUNK", "500"))
+PURGE_CHUNK = int(os.getenv("PURGE_CHUNK", "1000"))          # filas por lote (y por transacción)
+PURGE_PAUSE_SECS = float(os.getenv("PURGE_PAUSE_SECS", "0.05"))  # respiro entre lotes para el tráfico en vivo
+EXPORT_PAGE = int(os.getenv("EXPORT_PAGE", "2000"))  # filas por página (y por transacción) en /admin/export
+
+DELIVERY_ARCHIVE_RETENTION_DAYS = int(os.getenv("DELIVERY_ARCHIVE_RETENTION_DAYS", "365"))  # 0 = para siempre
+
+# Pool de conexiones por worker de gunicorn: cada hilo atiende un request y usa
+# una sola sesión, así que pool = hilos (+ overflow para los hilos de fondo)
+WEB_THREADS = int(os.getenv("WEB_THREADS", "4"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(WEB_THREADS)))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "4"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))   # Neon corta conexiones inactivas
+DB_PRE_PING = os.getenv("DB_PRE_PING", "0") == "1"           # un round trip extra por checkout
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"         # detrás de PgBouncer: que pool lo haga él
+
+# Métricas de rendimiento: cada worker vuelca las suyas aquí y /admin/perf las junta
+PERF_DIR = os.getenv("PERF_DIR") or os.path.join(tempfile.gettempdir(), "puremuse-perf")
+PERF_FLUSH_SECS = float(os.getenv("PERF_FLUSH_SECS", "5"))
+
+GALLERIES_PATH = os.getenv("GALLERIES_PATH") or os.path.join(os.getcwd(), "galleries.txt")
+GALLERIES_CHECK_SECS = float(os.getenv("GALLERIES_CHECK_SECS", "5"))
+
+# Permite apuntar a servidores locales (stubs) en pruebas y benchmarks
+TG_API_BASE = (os.getenv("TG_API_BASE", "") or "https://api.telegram.org").rstrip("/")
+MP_API_BASE = (os.getenv("MP_API_BASE", "") or "https://api.mercadopago.com").rstrip("/")
+
 # ========= CONSTANTES =========
-TG_BASE = f"https://api.telegram.org/bot{TOKEN}"
+TG_BASE = f"{TG_API_BASE}/bot{TOKEN}"
 TG_SEND_URL = f"{TG_BASE}/sendMessage"
 TG_SET_WEBHOOK_URL = f"{TG_BASE}/setWebhook"
 TG_GET_WEBHOOK_INFO_URL = f"{TG_BASE}/getWebhookInfo"
-MP_PREFS_URL = "https://api.mercadopago.com/checkout/preferences"
-MP_PAY_URL = "https://api.mercadopago.com/v1/payments/"
+TG_DELETE_WEBHOOK_URL = f"{TG_BASE}/deleteWebhook"
+TG_GET_UPDATES_URL = f"{TG_BASE}/getUpdates"
+MP_PREFS_URL = f"{MP_API_BASE}/checkout/preferences"
+MP_PAY_URL = f"{MP_API_BASE}/v1/payments/"
 TZ_MX = ZoneInfo("America/Mexico_City")
 
+# ========= PERF =========
+PERF_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class PerfRegistry:
+    """Histogramas de latencia, errores, in-flight y contadores, con etiquetas fijas.
+
+    Cada observación es (kind, labels): p.ej. ("http", {"route": "/telegram", "branch": "vip"}).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hist: dict[tuple, list] = {}      # clave → [buckets..., +Inf, sum, count, errors]
+        self.inflight: dict[tuple, int] = {}
+        self.counters: dict[tuple, int] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}  # nombre → función que devuelve el valor actual
+        self._next_flush = 0.0
+
+    @staticmethod
+    def _key(kind: str, labels: dict) -> tuple:
+        return (kind, tuple(sorted(labels.items())))
+
+    def observe(self, kind: str, labels: dict, seconds: float, error: bool = False):
+        key = self._key(kind, labels)
+        with self._lock:
+            h = self.hist.get(key)
+            if h is None:
+                h = self.hist[key] = [0] * (len(PERF_BUCKETS) + 1) + [0.0, 0, 0]
+            for i, le in enumerate(PERF_BUCKETS):
+                if seconds <= le:
+                    h[i] += 1
+                    break
+            else:
+                h[len(PERF_BUCKETS)] += 1
+            h[-3] += seconds
+            h[-2] += 1
+            if error:
+                h[-1] += 1
+
+    def inflight_add(self, kind: str, labels: dict, n: int):
+        key = self._key(kind, labels)
+        with self._lock:
+            self.inflight[key] = self.inflight.get(key, 0) + n
+
+    def inc(self, name: str, labels: dict, n: int = 1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    @contextmanager
+    def track(self, kind: str, **labels):
+        """Mide el bloque; una excepción, o `t.error = True`, cuenta como error."""
+        t = _PerfTimer()
+        self.inflight_add(kind, labels, 1)
+        t0 = time.perf_counter()
+        try:
+            yield t
+        except BaseException:
+            t.error = True
+            raise
+        finally:
+            self.inflight_add(kind, labels, -1)
+            self.observe(kind, labels, time.perf_counter() - t0, t.error)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snap = {
+                "pid": os.getpid(),
+                "ts": time.time(),
+                "hist": [[k, dict(l), list(v)] for (k, l), v in self.hist.items()],
+                "inflight": [[k, dict(l), v] for (k, l), v in self.inflight.items()],
+                "counters": [[k, dict(l), v] for (k, l), v in self.counters.items()],
+            }
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                pass
+        snap["gauges"] = gauges
+        return snap
+
+    def flush(self, force: bool = False):
+        """Vuelca el snapshot de este worker a PERF_DIR (como mucho cada PERF_FLUSH_SECS)."""
+        now = time.monotonic()
+        if not force and now < self._next_flush:
+            return
+        self._next_flush = now + PERF_FLUSH_SECS
+        try:
+            os.makedirs(PERF_DIR, exist_ok=True)
+            path = os.path.join(PERF_DIR, f"{os.getpid()}.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("⚠️ perf flush error:", e)
+
+class _PerfTimer:
+    error = False
+
+PERF = PerfRegistry()
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def perf_collect() -> list[dict]:
+    """Snapshots de todos los workers vivos (el propio, recién volcado)."""
+    PERF.flush(force=True)
+    snaps = []
+    try:
+        names = os.listdir(PERF_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(PERF_DIR, name)
+        try:
+            pid = int(name[:-5])
+            if pid != os.getpid() and not _pid_alive(pid):
+                os.remove(path)  # worker muerto (reinicio de gunicorn)
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                snaps.append(json.load(f))
+        except (ValueError, OSError):
+            continue
+    return snaps
+
+def perf_merge(snaps: list[dict]) -> dict:
+    hist: dict[tuple, list] = {}
+    inflight: dict[tuple, int] = {}
+    counters: dict[tuple, int] = {}
+    gauges: dict[str, float] = {}
+    for snap in snaps:
+        for kind, labels, v in snap.get("hist", []):
+            key = (kind, tuple(sorted(labels.items())))
+            cur = hist.get(key)
+            hist[key] = list(v) if cur is None else [a + b for a, b in zip(cur, v)]
+        for kind, labels, v in snap.get("inflight", []):
+            key = (kind, tuple(sorted(labels.items())))
+            inflight[key] = inflight.get(key, 0) + v
+        for name, labels, v in snap.get("counters", []):
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + v
+        for name, v in snap.get("gauges", {}).items():
+            gauges[name] = gauges.get(name, 0) + v
+    return {"hist": hist, "inflight": inflight, "counters": counters, "gauges": gauges, "workers": len(snaps)}
+
+def _bucket_quantile(h: list, q: float) -> Optional[float]:
+    """Cuantil aproximado (límite superior del bucket donde cae)."""
+    count = h[-2]
+    if not count:
+        return None
+    target = q * count
+    acc = 0
+    for i, le in enumerate(PERF_BUCKETS):
+        acc += h[i]
+        if acc >= target:
+            return le
+    return float("inf")
+
+def perf_json(merged: dict) -> dict:
+    def fmt(key):
+        kind, labels = key
+        return {"kind": kind, **dict(labels)}
+    def ms(v):
+        if v is None or v == float("inf"):
+            return None if v is None else "inf"
+        return round(v * 1000, 1)
+    out = []
+    for key, h in sorted(merged["hist"].items()):
+        count, errors = h[-2], h[-1]
+        out.append({
+            **fmt(key),
+            "count": count,
+            "errors": errors,
+            "error_rate": round(errors / count, 4) if count else 0.0,
+            "avg_ms": round(h[-3] / count * 1000, 2) if count else None,
+            "p50_le_ms": ms(_bucket_quantile(h, 0.5)),
+            "p95_le_ms": ms(_bucket_quantile(h, 0.95)),
+            "p99_le_ms": ms(_bucket_quantile(h, 0.99)),
+            "in_flight": merged["inflight"].get(key, 0),
+        })
+    return {
+        "workers": merged["workers"],
+        "latency": out,
+        "counters": [{"name": k, **dict(l), "value": v} for (k, l), v in sorted(merged["counters"].items())],
+        "gauges": merged["gauges"],
+    }
+
+def _prom_escape(v) -> str:
+    """Escapa barra invertida, comillas y saltos de línea en un valor de label."""
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in items) + "}"
+
+def perf_prometheus(merged: dict) -> str:
+    lines = ["# TYPE puremuse_latency_seconds histogram"]
+    for (kind, labels), h in sorted(merged["hist"].items()):
+        base = (("kind", kind),) + labels
+        acc = 0
+        for i, le in enumerate(PERF_BUCKETS):
+            acc += h[i]
+            lines.append(f"puremuse_latency_seconds_bucket{_prom_labels(base, ('le', le))} {acc}")
+        lines.append(f"puremuse_latency_seconds_bucket{_prom_labels(base, ('le', '+Inf'))} {h[-2]}")
+        lines.append(f"puremuse_latency_seconds_sum{_prom_labels(base)} {h[-3]:.6f}")
+        lines.append(f"puremuse_latency_seconds_count{_prom_labels(base)} {h[-2]}")
+    lines.append("# TYPE puremuse_errors_total counter")
+    for (kind, labels), h in sorted(merged["hist"].items()):
+        lines.append(f"puremuse_errors_total{_prom_labels((('kind', kind),) + labels)} {h[-1]}")
+    lines.append("# TYPE puremuse_in_flight gauge")
+    for (kind, labels), v in sorted(merged["inflight"].items()):
+        lines.append(f"puremuse_in_flight{_prom_labels((('kind', kind),) + labels)} {v}")
+    lines.append("# TYPE puremuse_events_total counter")
+    for (name, labels), v in sorted(merged["counters"].items()):
+        lines.append(f"puremuse_events_total{_prom_labels((('name', name),) + labels)} {v}")
+    lines.append("# TYPE puremuse_gauge gauge")
+    for name, v in sorted(merged["gauges"].items()):
+        lines.append(f"puremuse_gauge{_prom_labels((('name', name),))} {v}")
+    lines.append(f"puremuse_workers {merged['workers']}")
+    return "\n".join(lines) + "\n"
+
 # ========= DATABASE =========
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_recycle=300, echo=False, future=True)
+class PoolStats:
+    """Espera por conexión en cada checkout y edad de las conexiones abiertas (por proceso)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidated = 0
+        self.opened: dict[int, float] = {}  # id(ConnectionRecord) → monotonic al conectar
+
+    def observe_wait(self, seconds: float, timeout: bool = False):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_sum += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self.timeouts += timeout
+        PERF.observe("db_checkout", {}, seconds, timeout)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            ages = [now - t for t in self.opened.values()]
+            return {
+                "checkouts": self.checkouts,
+                "wait_avg_ms": round(self.wait_sum / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidated": self.invalidated,
+                "connections_open": len(ages),
+                "connection_age_max_s": round(max(ages), 1) if ages else 0.0,
+                "connection_age_avg_s": round(sum(ages) / len(ages), 1) if ages else 0.0,
+            }
+
+POOL_STATS = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    """QueuePool que mide cuánto espera cada checkout (incluye abrir la conexión si hace falta)."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            POOL_STATS.observe_wait(time.perf_counter() - t0, timeout=True)
+            raise
+        POOL_STATS.observe_wait(time.perf_counter() - t0)
+        return conn
+
+def engine_options(url: str) -> dict:
+    opts = {"echo": False, "future": True, "pool_pre_ping": DB_PRE_PING}
+    if DB_PGBOUNCER:
+        # PgBouncer ya reparte conexiones: abrir/cerrar aquí es barato y nada queda retenido
+        opts["poolclass"] = NullPool
+    elif url and make_url(url).get_backend_name() == "postgresql":
+        opts.update(poolclass=TimedQueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_use_lifo=True)
+    else:
+        opts["pool_recycle"] = DB_POOL_RECYCLE  # SQLite (pruebas, bench): el pool que elija el dialecto
+    return opts
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+@event.listens_for(engine, "connect")
+def _pool_connect(dbapi_conn, record):
+    with POOL_STATS.lock:
+        POOL_STATS.connects += 1
+        POOL_STATS.opened[id(record)] = time.monotonic()
+
+@event.listens_for(engine, "close")
+def _pool_close(dbapi_conn, record):
+    with POOL_STATS.lock:
+        POOL_STATS.opened.pop(id(record), None)
+
+@event.listens_for(engine, "invalidate")
+def _pool_invalidate(dbapi_conn, record, exc):
+    with POOL_STATS.lock:
+        POOL_STATS.invalidated += 1
+
+@contextmanager
+def db_session():
+    """La sesión del request en curso (una por request, la cierra el teardown).
+
+    Fuera de un request (workers, cron por CLI, polling) abre y cierra una propia.
+    """
+    if not has_request_context():
+        with SessionLocal() as db:
+            yield db
+        return
+    db = g.get("db")
+    if db is None:
+        db = g.db = SessionLocal()
+    try:
+        yield db
+    except BaseException:
+        db.rollback()  # que el resto del request pueda seguir usándola
+        raise
+
+# Contador de round trips a la DB (por hilo, se reinicia en cada request)
+_db_local = threading.local()
+_db_stats_lock = threading.Lock()
+DB_STATS: dict[str, list[int]] = {}  # endpoint → [requests, queries]
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_db_query(conn, cursor, statement, parameters, context, executemany):
+    _db_local.queries = getattr(_db_local, "queries", 0) + 1
+    conn.info.setdefault("perf_q", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _time_db_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("perf_q")
+    if starts:
+        PERF.observe("db_query", {}, time.perf_counter() - starts.pop())
+
+@event.listens_for(engine, "handle_error")
+def _time_db_error(ctx):
+    starts = ctx.connection.info.get("perf_q") if ctx.connection is not None else None
+    if starts:
+        PERF.observe("db_query", {}, time.perf_counter() - starts.pop(), error=True)
+
+@event.listens_for(SessionLocal, "after_begin")
+def _db_session_begin(session, transaction, connection):
+    if "perf_t0" not in session.info:
+        session.info["perf_t0"] = time.perf_counter()
+        PERF.inflight_add("db_session", {}, 1)
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def _db_session_end(session, transaction):
+    if transaction.parent is None and "perf_t0" in session.info:
+        PERF.inflight_add("db_session", {}, -1)
+        PERF.observe("db_session", {}, time.perf_counter() - session.info.pop("perf_t0"))
+
 class Base(DeclarativeBase):
     pass
 
@@ -57,16 +511,55 @@ class VIPUser(Base):
     chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     username: Mapped[Optional[str]] = mapped_column(String(150), nullable=True)
     start_date: Mapped[date] = mapped_column(Date, nullable=False)
-    active_until: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    active_until: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
     last_sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
-
-class VIPDelivery(Base):
-    __tablename__ = "vip_deliveries"
+    # posición (en vip_galleries) de la última galería entregada
+    gallery_cursor: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # active_until para el que ya se mandó el recordatorio / el aviso de vencido (al renovar cambia)
+    reminded_for: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    expired_notified_for: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+class VIPGallery(Base):
+    """Espejo en DB de galleries.txt, para elegir la siguiente galería con SQL."""
+    __tablename__ = "vip_galleries"
+    __table_args__ = (UniqueConstraint("gallery_hash", name="uq_gallery_hash"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
-    gallery_hash: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    gallery_hash: Mapped[str] = mapped_column(String(64), nullable=False)
     url: Mapped[str] = mapped_column(String(2048), nullable=False)
+    # índice en galleries.txt: 0 = galería gratis, -1 = ya no está en el archivo
+    position: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+
+class VIPDelivery(Base):
+    """Una fila por galería entregada: solo ids y fecha (la url vive en vip_galleries).
+
+    La PK (chat_id, gallery_id) es a la vez el índice del anti-join del picker y
+    la garantía de no repetir galería.
+    """
+    __tablename__ = "vip_delivery_log"
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    gallery_id: Mapped[int] = mapped_column(Integer, primary_key=True)  # vip_galleries.id
+    sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
+class VIPDeliveryArchive(Base):
+    """Entregas de usuarios vencidos hace mucho, fuera de la tabla caliente."""
+    __tablename__ = "vip_delivery_archive"
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    gallery_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
+# Formato anterior de las entregas (url + hash hex por fila). Va en otra MetaData para
+# que create_all no lo cree; lo leen migrate_legacy_deliveries (en segundo plano al
+# arrancar o con `flask --app bot migrate-deliveries`) y el picker mientras tanto.
+legacy_metadata = MetaData()
+legacy_deliveries = Table(
+    "vip_deliveries", legacy_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("chat_id", BigInteger, nullable=False),
+    Column("gallery_hash", String(64), nullable=False),
+    Column("url", String(2048), nullable=False),
+    Column("sent_at", DateTime, nullable=False),
+)
 
 class VIPPayment(Base):
     __tablename__ = "vip_payments"
@@ -79,6 +572,58 @@ class VIPPayment(Base):
     status: Mapped[str] = mapped_column(String(20), nullable=False)
     approved_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
 
+class DailyStat(Base):
+    """Resumen por día de Ciudad de México, mantenido al aprobar pagos y entregar galerías."""
+    __tablename__ = "vip_daily_stats"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    payments: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    revenue_mxn: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    new_vips: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    deliveries: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    expirations: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")  # VIPs cuyo active_until cae ese día
+
+class MPInbox(Base):
+    """Notificaciones de Mercado Pago recibidas, pendientes o ya aplicadas."""
+    __tablename__ = "mp_inbox"
+    __table_args__ = (UniqueConstraint("mp_payment_id", name="uq_inbox_mp_id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    mp_payment_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    # pending → processing → done | skipped (no aprobado aún) | failed (se reintenta)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending", index=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    received_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+
+class JobRun(Base):
+    """Progreso de un job por lotes, para poder reanudarlo tras una caída."""
+    __tablename__ = "job_runs"
+    __table_args__ = (UniqueConstraint("job", "run_key", name="uq_job_run"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    job: Mapped[str] = mapped_column(String(40), nullable=False)
+    run_key: Mapped[str] = mapped_column(String(64), nullable=False)
+    cursor: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)  # último id procesado
+    processed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="running")
+    params: Mapped[Optional[str]] = mapped_column(String(1024), nullable=True)  # JSON con la configuración del job
+    started_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+class ProcessedUpdate(Base):
+    """update_id de Telegram ya atendidos; la PK descarta los reintentos entre workers."""
+    __tablename__ = "tg_updates"
+    update_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    received_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
+class BotState(Base):
+    """Valores sueltos que deben sobrevivir reinicios (p. ej. el offset de getUpdates)."""
+    __tablename__ = "bot_state"
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    value: Mapped[str] = mapped_column(String(255), nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
 
 # ========= UTILS =========
 def esc(s: str) -> str:
@@ -93,12 +638,63 @@ def day_mx() -> date:
 def url_hash(u: str) -> str:
     return hashlib.sha256(u.encode("utf-8")).hexdigest()
 
-def read_galleries() -> list[str]:
-    path = os.path.join(os.getcwd(), "galleries.txt")
-    if not os.path.exists(path):
-        return []
-    with open(path, "r", encoding="utf-8") as f:
-        return [ln.strip() for ln in f if ln.strip()]
+class CatalogSnapshot(NamedTuple):
+    urls: tuple[str, ...]
+    positions: dict[str, int]      # sha256 de la url → índice en el archivo
+    version: int
+
+class GalleryCatalog:
+    """Catálogo de galerías en memoria; recarga galleries.txt solo si cambia mtime/tamaño.
+
+    Cada recarga arma un snapshot inmutable nuevo y lo publica de una sola vez,
+    así los lectores nunca ven un catálogo a medias ni necesitan locks.
+    """
+
+    def __init__(self, path: str, check_secs: float = 5.0):
+        self.path = path
+        self.check_secs = check_secs
+        self._snap = CatalogSnapshot((), {}, 0)
+        self._stamp = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def reload(self, force: bool = False) -> bool:
+        """Relee el archivo si cambió (o siempre con force). Devuelve True si recargó."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_secs
+            stamp = self._stat()
+            if not force and stamp == self._stamp:
+                return False
+            urls: list[str] = []
+            if stamp is not None:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    urls = [ln.strip() for ln in f if ln.strip()]
+            positions: dict[str, int] = {}
+            for i, u in enumerate(urls):
+                positions.setdefault(url_hash(u), i)
+            self._snap = CatalogSnapshot(tuple(urls), positions, self._snap.version + 1)
+            self._stamp = stamp
+            return True
+
+    def snapshot(self) -> CatalogSnapshot:
+        # Un stat() cada check_secs como mucho; el resto de las lecturas no toca disco
+        if time.monotonic() >= self._next_check:
+            self.reload()
+        return self._snap
+
+    @property
+    def free(self) -> Optional[str]:
+        snap = self.snapshot()
+        return snap.urls[0] if snap.urls else None
+
+catalog = GalleryCatalog(GALLERIES_PATH, GALLERIES_CHECK_SECS)
 
 def is_active(u: VIPUser) -> bool:
     """Devuelve True si el usuario sigue activo."""
@@ -132,21 +728,236 @@ def build_keyboard() -> dict:
         "input_field_placeholder": "Choose an option…",
     }
 
-def tg_send(chat_id: int, text: str, preview=False, kb=True):
+# El teclado nunca cambia: se serializa una vez y se pega tal cual en cada mensaje
+KEYBOARD_JSON = json.dumps(build_keyboard(), separators=(",", ":"), ensure_ascii=False)
+
+# ========= Telegram sender =========
+def pooled_session(pool_size: int) -> requests.Session:
+    """Sesión HTTP keep-alive con pool de conexiones reutilizables."""
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+TG_HTTP = pooled_session(TG_SEND_WORKERS + 2)
+
+class TokenBucket:
+    """Token bucket thread-safe: `rate` tokens por segundo, ráfagas hasta `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self) -> float:
+        """Toma un token y devuelve cuántos segundos hay que esperar para usarlo."""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def try_take(self) -> float:
+        """Toma un token si hay uno ya; si no, no toma nada y devuelve cuánto falta."""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        with self.lock:
+            self._refill()
+            return self.tokens >= self.burst
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+_tg_global_bucket = TokenBucket(TG_GLOBAL_RATE, max(1, int(TG_GLOBAL_RATE)))
+_tg_chat_buckets: dict[int, TokenBucket] = {}
+_tg_chat_lock = threading.Lock()
+_tg_paused_until = 0.0  # fijado por un 429 de Telegram (retry_after)
+_tg_queues: list[queue.Queue] = []
+_tg_workers_pid = None
+_tg_workers_lock = threading.Lock()
+
+def _tg_chat_bucket(chat_id: int) -> TokenBucket:
+    with _tg_chat_lock:
+        b = _tg_chat_buckets.get(chat_id)
+        if b is None:
+            if len(_tg_chat_buckets) > 10000:
+                # Un bucket lleno es igual a uno nuevo: descartarlo no cambia nada.
+                # Los de chats con envíos recientes se quedan
+                for k in [k for k, v in _tg_chat_buckets.items() if v.full()]:
+                    del _tg_chat_buckets[k]
+            b = _tg_chat_buckets[chat_id] = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+        return b
+
+def _tg_post(chat_id: int, body: bytes, have_token: bool = False):
+    """Envía un sendMessage ya serializado respetando los límites de Telegram y reintentando los 429.
+
+    Con have_token, quien llama ya tomó el token del chat para el primer intento.
+    Devuelve False si vale la pena reintentar más tarde (red, 5xx, 429 agotados).
+    """
+    global _tg_paused_until
+    for _ in range(TG_MAX_RETRIES + 1):
+        pause = _tg_paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        if not have_token:
+            _tg_chat_bucket(chat_id).acquire()
+        have_token = False
+        _tg_global_bucket.acquire()
+        try:
+            with PERF.track("outbound", target="tg_send") as t:
+                r = TG_HTTP.post(TG_SEND_URL, data=body, headers=JSON_HEADERS, timeout=15)
+                t.error = r.status_code >= 400
+        except Exception as e:
+            print("⚠️ Telegram send exception:", e)
+            return False
+        if r.status_code != 429:
+            if r.status_code >= 400:
+                print("⚠️ Telegram send error:", r.status_code, r.text[:200])
+            return r.status_code < 500  # 403 (bot bloqueado) y similares no mejoran reintentando
+        PERF.inc("tg_rate_limited", {})
+        try:
+            retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            retry_after = 1.0
+        _tg_paused_until = max(_tg_paused_until, time.monotonic() + retry_after)
+    print("⚠️ Telegram send dropped after retries:", chat_id)
+    return False
+
+def _tg_worker(q: queue.Queue):
+    """Un shard de envíos. Un chat sin tokens no frena a los demás: sus mensajes esperan
+    aparte (en orden) y el worker sigue con los de otros chats."""
+    pending: dict[int, deque] = {}   # chat → mensajes aún sin enviar
+    ready: list = []                 # heap (cuándo puede enviar, seq, chat), uno por chat en pending
+    seq = 0
+    held = 0
+    while True:
+        now = time.monotonic()
+        while ready and ready[0][0] <= now:
+            _, _, chat_id = heapq.heappop(ready)
+            wait = _tg_chat_bucket(chat_id).try_take()
+            if wait > 0:
+                seq += 1
+                heapq.heappush(ready, (now + wait, seq, chat_id))
+                continue
+            msgs = pending[chat_id]
+            try:
+                _tg_post(chat_id, msgs.popleft(), have_token=True)
+            except Exception as e:
+                print("⚠️ Telegram worker error:", e)
+            finally:
+                held -= 1
+                q.task_done()
+            if msgs:
+                seq += 1
+                heapq.heappush(ready, (time.monotonic(), seq, chat_id))
+            else:
+                del pending[chat_id]
+            now = time.monotonic()
+
+        if held >= TG_QUEUE_MAX:
+            time.sleep(max(0.0, ready[0][0] - now))  # lleno: que la cola haga backpressure
+            continue
+        try:
+            chat_id, body = q.get(timeout=max(0.0, ready[0][0] - now) if ready else None)
+        except queue.Empty:
+            continue
+        held += 1
+        if chat_id in pending:
+            pending[chat_id].append(body)
+        else:
+            pending[chat_id] = deque([body])
+            seq += 1
+            heapq.heappush(ready, (time.monotonic(), seq, chat_id))
+
+def _tg_start_workers():
+    """Arranca los workers en este proceso (tras el fork de gunicorn, una vez por PID)."""
+    global _tg_queues, _tg_workers_pid
+    with _tg_workers_lock:
+        if _tg_workers_pid == os.getpid():
+            return
+        _tg_queues = [queue.Queue(maxsize=TG_QUEUE_MAX) for _ in range(max(1, TG_SEND_WORKERS))]
+        for i, q in enumerate(_tg_queues):
+            threading.Thread(target=_tg_worker, args=(q,), name=f"tg-send-{i}", daemon=True).start()
+        _tg_workers_pid = os.getpid()
+
+def tg_queue_depth() -> int:
+    return sum(q.qsize() for q in _tg_queues) if _tg_workers_pid == os.getpid() else 0
+
+def tg_flush():
+    """Espera a que los workers de este proceso envíen todo lo encolado."""
+    if _tg_workers_pid == os.getpid():
+        for q in _tg_queues:
+            q.join()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def payload_tail(text: str, preview=False, kb=True) -> bytes:
+    """Todo el JSON de sendMessage menos el chat_id: `,"text":...}`."""
+    tail = json.dumps({"text": text, "parse_mode": "HTML", "disable_web_page_preview": not preview},
+                      separators=(",", ":"), ensure_ascii=False)[1:-1]
+    if kb:
+        tail += ',"reply_markup":' + KEYBOARD_JSON
+    return ("," + tail + "}").encode()
+
+def tg_body(chat_id: int, tail: bytes) -> bytes:
+    return b'{"chat_id":%d' % chat_id + tail
+
+def tg_webhook_body(chat_id: int, tail: bytes) -> bytes:
+    """Respuesta en el cuerpo del webhook (Telegram la ejecuta sin otra petición nuestra)."""
+    return b'{"method":"sendMessage","chat_id":%d' % chat_id + tail
+
+class StaticReply:
+    """Respuesta fija: su JSON se arma una sola vez al importar el módulo."""
+    __slots__ = ("text", "tail")
+
+    def __init__(self, text: str, preview=False, kb=True):
+        self.text = text
+        self.tail = payload_tail(text, preview, kb)
+
+def tg_send_body(chat_id: int, body: bytes):
     if not TOKEN:
         return
-    payload = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "HTML",
-        "disable_web_page_preview": not preview,
-    }
-    if kb:
-        payload["reply_markup"] = build_keyboard()
+    if TG_SEND_MODE == "sync":
+        _tg_post(chat_id, body)
+        return
+    if _tg_workers_pid != os.getpid():
+        _tg_start_workers()
+    # Cada chat siempre cae en la misma cola → se conserva el orden de sus mensajes
+    q = _tg_queues[chat_id % len(_tg_queues)]
     try:
-        requests.post(TG_SEND_URL, json=payload, timeout=15)
-    except Exception as e:
-        print("⚠️ Telegram send exception:", e)
+        q.put_nowait((chat_id, body))
+    except queue.Full:
+        # Cola llena: enviamos en línea (backpressure) en vez de perder el mensaje
+        _tg_post(chat_id, body)
+
+def tg_send(chat_id: int, text, preview=False, kb=True):
+    """Encola un mensaje; `text` puede ser un str o un StaticReply ya serializado."""
+    tail = text.tail if isinstance(text, StaticReply) else payload_tail(text, preview, kb)
+    tg_send_body(chat_id, tg_body(chat_id, tail))
+
+def tg_send_now(chat_id: int, text, preview=False, kb=True) -> bool:
+    """Envía en este hilo, sin cola. False si no salió y conviene reintentar después."""
+    if not TOKEN:
+        return True
+    tail = text.tail if isinstance(text, StaticReply) else payload_tail(text, preview, kb)
+    return _tg_post(chat_id, tg_body(chat_id, tail))
 
 def notify_owner(text: str):
     try:
@@ -154,18 +965,253 @@ def notify_owner(text: str):
     except Exception as e:
         print("⚠️ Owner notify error:", e)
 
-def ensure_schema_safe():
-    """Garantiza que las tablas existan, incluso si Neon tarda o falla."""
-    try:
-        Base.metadata.create_all(bind=engine)
+# Cambios sobre tablas ya existentes que create_all no aplica (solo Postgres).
+# Cada parche: (consulta que devuelve fila si ya está aplicado, sentencias).
+SCHEMA_PATCHES = [
+    (
+        "SELECT 1 FROM information_schema.columns WHERE table_name='vip_users' AND column_name='gallery_cursor'",
+        ["ALTER TABLE vip_users ADD COLUMN IF NOT EXISTS gallery_cursor INTEGER NOT NULL DEFAULT 0"],
+    ),
+    (
+        "SELECT 1 FROM pg_indexes WHERE indexname='ix_vip_users_active_until'",
+        ["CREATE INDEX IF NOT EXISTS ix_vip_users_active_until ON vip_users (active_until)"],
+    ),
+    (
+        "SELECT 1 FROM information_schema.columns WHERE table_name='vip_users' AND column_name='expired_notified_for'",
+        [
+            "ALTER TABLE vip_users ADD COLUMN IF NOT EXISTS reminded_for TIMESTAMP",
+            "ALTER TABLE vip_users ADD COLUMN IF NOT EXISTS expired_notified_for TIMESTAMP",
+        ],
+    ),
+    (
+        "SELECT 1 FROM information_schema.columns WHERE table_name='job_runs' AND column_name='params'",
+        ["ALTER TABLE job_runs ADD COLUMN IF NOT EXISTS params VARCHAR(1024)"],
+    ),
+]
+
+def apply_schema_patches(conn):
+    if conn.dialect.name != "postgresql":
+        return
+    for probe, statements in SCHEMA_PATCHES:
+        if conn.execute(text(probe)).first():
+            continue
+        try:
+            with conn.begin_nested():
+                for stmt in statements:
+                    conn.execute(text(stmt))
+        except Exception as e:
+            print("⚠️ schema patch failed:", e)
+
+SCHEMA_LOCK_KEY = 0x5075_4D75  # clave del advisory lock de Postgres para el bootstrap
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_schema_safe(force: bool = False):
+    """Garantiza que las tablas existan, incluso si Neon tarda o falla.
+
+    Se verifica una sola vez por proceso; después solo cuesta leer un flag.
+    Con force=True (tras un ProgrammingError/OperationalError) se vuelve a revisar.
+    """
+    global _schema_ready, _legacy_deliveries_pending
+    if _schema_ready and not force:
         return True
-    except Exception as e:
-        print("⚠️ ensure_schema_safe error:", e)
-        notify_owner(f"⚠️ DB schema check failed:\n<pre>{esc(str(e))}</pre>")
-        return False
+    with _schema_lock:
+        if _schema_ready and not force:
+            return True
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    # Los workers de gunicorn arrancan a la vez: uno crea, los demás esperan
+                    conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": SCHEMA_LOCK_KEY})
+                Base.metadata.create_all(bind=conn)
+                apply_schema_patches(conn)
+            # Aquí solo DDL: el historial viejo y el rollup se llenan en segundo plano;
+            # mientras tanto, el picker también excluye lo que hay en vip_deliveries
+            _legacy_deliveries_pending = legacy_migration_pending()
+            _schema_ready = True
+            start_data_bootstrap()
+            return True
+        except Exception as e:
+            _schema_ready = False
+            print("⚠️ ensure_schema_safe error:", e)
+            notify_owner(f"⚠️ DB schema check failed:\n<pre>{esc(str(e))}</pre>")
+            return False
+
+def recheck_schema_on(e: Exception):
+    """Si el error puede venir de una tabla/columna faltante, revisar el esquema otra vez."""
+    if isinstance(e, (ProgrammingError, OperationalError)):
+        ensure_schema_safe(force=True)
+
+# ========= VIP cache =========
+class VIPRecord(NamedTuple):
+    chat_id: int
+    active_until: Optional[datetime]
+    last_sent_at: Optional[datetime]
+
+_MISS = object()
+
+class LRUCache:
+    """LRU con TTL por entrada, thread-safe. get() devuelve _MISS si no hay dato vigente."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return _MISS
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return _MISS
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class RedisCache:
+    """Misma interfaz que LRUCache sobre un servidor compatible con Redis."""
+
+    def __init__(self, url: str, prefix: str, ttl: float, dumps, loads):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.dumps = dumps
+        self.loads = loads
+
+    def get(self, key):
+        try:
+            raw = self.client.get(f"{self.prefix}{key}")
+        except Exception as e:
+            print("⚠️ cache get error:", e)
+            return _MISS
+        return _MISS if raw is None else self.loads(raw)
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        try:
+            self.client.set(f"{self.prefix}{key}", self.dumps(value), px=int((self.ttl if ttl is None else ttl) * 1000))
+        except Exception as e:
+            print("⚠️ cache set error:", e)
+
+    def delete(self, key):
+        try:
+            self.client.delete(f"{self.prefix}{key}")
+        except Exception as e:
+            print("⚠️ cache delete error:", e)
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(f"{self.prefix}*", count=500))
+            if keys:
+                self.client.delete(*keys)
+        except Exception as e:
+            print("⚠️ cache clear error:", e)
+
+def _vip_dumps(rec: Optional[VIPRecord]) -> str:
+    if rec is None:
+        return "null"
+    return json.dumps([rec.chat_id,
+                       rec.active_until.isoformat() if rec.active_until else None,
+                       rec.last_sent_at.isoformat() if rec.last_sent_at else None])
+
+def _vip_loads(raw) -> Optional[VIPRecord]:
+    v = json.loads(raw)
+    if v is None:
+        return None
+    return VIPRecord(v[0],
+                     datetime.fromisoformat(v[1]) if v[1] else None,
+                     datetime.fromisoformat(v[2]) if v[2] else None)
+
+def make_vip_cache():
+    if VIP_CACHE_URL:
+        if redis is None:
+            print("⚠️ VIP_CACHE_URL set but redis package missing; using in-process cache")
+        else:
+            return RedisCache(VIP_CACHE_URL, "puremuse:vip:", VIP_CACHE_TTL, _vip_dumps, _vip_loads)
+    return LRUCache(VIP_CACHE_SIZE, VIP_CACHE_TTL)
+
+vip_cache = make_vip_cache()
+
+def vip_lookup(chat_id: int) -> Optional[VIPRecord]:
+    """Estado VIP del chat (None si no es VIP). Si está en caché no toca la DB."""
+    rec = vip_cache.get(chat_id)
+    if rec is not _MISS:
+        return rec
+    try:
+        with db_session() as db:
+            row = db.execute(
+                select(VIPUser.chat_id, VIPUser.active_until, VIPUser.last_sent_at).where(VIPUser.chat_id == chat_id)
+            ).first()
+    except (ProgrammingError, OperationalError) as e:
+        recheck_schema_on(e)
+        return None
+    rec = VIPRecord(*row) if row else None
+    vip_cache.set(chat_id, rec, ttl=VIP_CACHE_TTL if rec else VIP_CACHE_NEG_TTL)
+    return rec
+
+def vip_invalidate(chat_id: Optional[int] = None):
+    """Borra un chat de la caché, o toda la caché si chat_id es None."""
+    if chat_id is None:
+        vip_cache.clear()
+    else:
+        vip_cache.delete(chat_id)
 
 # ========= Mercado Pago =========
+MP_HTTP = pooled_session(8)
+_mp_link_cache = LRUCache(10000, MP_LINK_TTL)
+_mp_link_inflight: dict[int, threading.Event] = {}
+_mp_link_lock = threading.Lock()
+
 def mp_create_link(chat_id: int) -> str:
+    """Link de pago del chat; reutiliza el de los últimos MP_LINK_TTL segundos.
+
+    Si el mismo chat pide el link varias veces a la vez, solo una llamada va a
+    Mercado Pago y las demás esperan su resultado.
+    """
+    link = _mp_link_cache.get(chat_id)
+    if link is not _MISS:
+        PERF.inc("mp_link_cache", {"result": "hit"})
+        return link
+    PERF.inc("mp_link_cache", {"result": "miss"})
+    with _mp_link_lock:
+        ev = _mp_link_inflight.get(chat_id)
+        leader = ev is None
+        if leader:
+            ev = _mp_link_inflight[chat_id] = threading.Event()
+    if not leader:
+        ev.wait(25)
+        link = _mp_link_cache.get(chat_id)
+        if link is not _MISS:
+            return link
+        return mp_create_preference(chat_id)  # la llamada original falló
+    try:
+        link = mp_create_preference(chat_id)
+        if link:
+            _mp_link_cache.set(chat_id, link)
+        return link
+    finally:
+        with _mp_link_lock:
+            _mp_link_inflight.pop(chat_id, None)
+        ev.set()
+
+def mp_preference_request(chat_id: int) -> tuple[dict, dict]:
+    """Headers y cuerpo para crear la preferencia de pago de un chat."""
     if not MP_ACCESS_TOKEN or not BASE_URL:
         raise RuntimeError("Missing MP_ACCESS_TOKEN or BASE_URL")
     headers = {"Authorization": f"Bearer {MP_ACCESS_TOKEN}", "Content-Type": "application/json"}
@@ -176,8 +1222,13 @@ def mp_create_link(chat_id: int) -> str:
         "back_urls": {"success": f"{BASE_URL}/paid?status=success"},
         "auto_return": "approved",
     }
-    r = requests.post(MP_PREFS_URL, headers=headers, json=data, timeout=20)
-    r.raise_for_status()
+    return headers, data
+
+def mp_create_preference(chat_id: int) -> str:
+    headers, data = mp_preference_request(chat_id)
+    with PERF.track("outbound", target="mp_create_link"):
+        r = MP_HTTP.post(MP_PREFS_URL, headers=headers, json=data, timeout=20)
+        r.raise_for_status()
     payload = r.json()
     return payload.get("init_point") or payload.get("sandbox_init_point")
 
@@ -185,27 +1236,897 @@ def mp_fetch_payment(payment_id: str) -> Optional[dict]:
     if not MP_ACCESS_TOKEN:
         return None
     headers = {"Authorization": f"Bearer {MP_ACCESS_TOKEN}"}
-    r = requests.get(MP_PAY_URL + str(payment_id), headers=headers, timeout=20)
+    with PERF.track("outbound", target="mp_fetch_payment") as t:
+        r = MP_HTTP.get(MP_PAY_URL + str(payment_id), headers=headers, timeout=20)
+        t.error = r.status_code != 200
     if r.status_code == 200:
         return r.json()
     return None
 
-# ========= Gallery Logic =========
-def pick_new_from_pool(db, chat_id: int, pool: Iterable[str]) -> Optional[str]:
-    sent_hashes = {row[0] for row in db.execute(select(VIPDelivery.gallery_hash).where(VIPDelivery.chat_id == chat_id))}
-    for link in pool:
-        if url_hash(link) not in sent_hashes:
-            return link
-    return None
+# ========= Daily stats =========
+def bump_daily(db, day: date, **deltas: int):
+    """Suma deltas a la fila de `day` en vip_daily_stats (dentro de la transacción de db)."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    stmt = (update(DailyStat).where(DailyStat.day == day)
+            .values({k: getattr(DailyStat, k) + v for k, v in deltas.items()})
+            .execution_options(synchronize_session=False))
+    if db.execute(stmt).rowcount:
+        return
+    try:
+        with db.begin_nested():
+            db.add(DailyStat(day=day, **{k: deltas.get(k, 0) for k in
+                                         ("payments", "revenue_mxn", "new_vips", "deliveries", "expirations")}))
+    except IntegrityError:
+        db.execute(stmt)  # otro hilo creó la fila del día primero
+
+def _as_date(v) -> Optional[date]:
+    # func.date() devuelve date en Postgres y texto en SQLite
+    if v is None or isinstance(v, date):
+        return v
+    return date.fromisoformat(str(v)[:10])
+
+def backfill_daily_stats() -> int:
+    """Reconstruye vip_daily_stats desde las tablas de pagos, entregas y usuarios."""
+    with SessionLocal() as db:
+        days = rebuild_daily_stats(db)
+        db.commit()
+    return days
+
+def rebuild_daily_stats(db) -> int:
+    rows: dict[date, dict[str, int]] = {}
+
+    def add(day, **vals):
+        day = _as_date(day)
+        if day is None:
+            return
+        r = rows.setdefault(day, {"payments": 0, "revenue_mxn": 0, "new_vips": 0, "deliveries": 0, "expirations": 0})
+        for k, v in vals.items():
+            r[k] += int(v or 0)
+
+    for d, n, total in db.execute(
+        select(func.date(VIPPayment.approved_at), func.count(VIPPayment.id), func.sum(VIPPayment.amount_mxn))
+        .group_by(func.date(VIPPayment.approved_at))
+    ):
+        add(d, payments=n, revenue_mxn=total)
+    first_pay = (select(func.min(VIPPayment.approved_at).label("first"))
+                 .group_by(VIPPayment.chat_id).subquery())
+    for d, n in db.execute(
+        select(func.date(first_pay.c.first), func.count()).group_by(func.date(first_pay.c.first))
+    ):
+        add(d, new_vips=n)
+    for d, n in db.execute(
+        select(func.date(VIPDelivery.sent_at), func.count()).group_by(func.date(VIPDelivery.sent_at))
+    ):
+        add(d, deliveries=n)
+    for d, n in db.execute(
+        select(func.date(VIPUser.active_until), func.count(VIPUser.id)).group_by(func.date(VIPUser.active_until))
+    ):
+        add(d, expirations=n)
+    db.execute(delete(DailyStat))
+    if rows:
+        db.execute(insert(DailyStat), [{"day": d, **vals} for d, vals in rows.items()])
+    return len(rows)
+
+def bootstrap_daily_stats() -> Optional[int]:
+    """Llena vip_daily_stats desde el historial una sola vez por base de datos.
+
+    Solo si el rollup está vacío o si se copiaron entregas viejas (la migración no
+    pasa por bump_daily). Devuelve los días reconstruidos, o None si no hizo falta.
+    """
+    with SessionLocal() as db:
+        # El lock sobre el JobRun hace que solo un proceso lo reconstruya
+        run = get_job_run(db, "backfill_daily_stats", "v1")
+        if run.status == "done":
+            db.commit()
+            return None
+        migrated = db.scalar(select(JobRun.processed).where(
+            JobRun.job == "migrate_deliveries", JobRun.run_key == "v1"))
+        empty = not db.scalar(select(exists().select_from(DailyStat)))
+        days = rebuild_daily_stats(db) if empty or migrated else None
+        now = now_mx().replace(tzinfo=None)
+        run.status, run.processed = "done", days or 0
+        run.updated_at = run.finished_at = now
+        db.commit()
+    return days
+
+# ========= Mercado Pago inbox =========
+MP_STATS = {"received": 0, "duplicates": 0, "applied": 0, "skipped": 0, "failed": 0,
+            "latency_sum": 0.0, "latency_max": 0.0}
+_mp_stats_lock = threading.Lock()
+_mp_queue: "queue.Queue[str]" = queue.Queue()
+_mp_worker_pid = None
+_mp_worker_lock = threading.Lock()
+
+def _mp_stat(key: str, latency: Optional[float] = None):
+    with _mp_stats_lock:
+        MP_STATS[key] += 1
+        if latency is not None:
+            MP_STATS["latency_sum"] += latency
+            MP_STATS["latency_max"] = max(MP_STATS["latency_max"], latency)
+
+def mp_inbox_record(db, pid: str) -> bool:
+    """Anota la notificación. Devuelve False si ese pago ya se aplicó o ya está en cola."""
+    now = now_mx().replace(tzinfo=None)
+    row = db.execute(select(MPInbox).where(MPInbox.mp_payment_id == pid)).scalar_one_or_none()
+    if row is None:
+        try:
+            db.add(MPInbox(mp_payment_id=pid, status="pending", attempts=0, received_at=now, updated_at=now))
+            db.commit()
+        except IntegrityError:
+            # Llegó el mismo aviso por otro hilo/worker al mismo tiempo
+            db.rollback()
+            _mp_stat("duplicates")
+            return False
+        _mp_stat("received")
+        return True
+    if row.status == "pending" and row.updated_at < now - timedelta(seconds=MP_INBOX_SCAN_SECS):
+        # Lleva rato en cola: su worker pudo morir. Se encola otra vez; el claim de
+        # process_mp_notification evita que se aplique dos veces
+        _mp_stat("received")
+        return True
+    if row.status in ("done", "processing", "pending"):
+        _mp_stat("duplicates")
+        return False
+    # skipped/failed: MP avisa de nuevo cuando el pago cambia de estado (p.ej. pending → approved)
+    row.status = "pending"
+    row.received_at = row.updated_at = now
+    db.commit()
+    _mp_stat("received")
+    return True
+
+def _mp_inbox_finish(pid: str, status: str, error: Optional[str] = None):
+    now = now_mx().replace(tzinfo=None)
+    with SessionLocal() as db:
+        db.execute(update(MPInbox).where(MPInbox.mp_payment_id == pid).values(
+            status=status, updated_at=now, processed_at=now, last_error=(error or "")[:255] or None))
+        db.commit()
+
+def apply_payment(pid: str, p: dict) -> bool:
+    """Extiende el VIP y registra el pago en una sola transacción. False si ya estaba aplicado."""
+    chat_id = int(p.get("external_reference") or 0)
+    now = now_mx()
+    naive_now = now.replace(tzinfo=None)
+    amount = int(p.get("transaction_amount") or 0)
+    new_until = (now + timedelta(days=30)).replace(tzinfo=None)
+    with SessionLocal() as db:
+        u = db.execute(select(VIPUser).where(VIPUser.chat_id == chat_id).with_for_update()).scalar_one_or_none()
+        bump_daily(db, now.date(), payments=1, revenue_mxn=amount, new_vips=0 if u else 1)
+        if u and u.active_until and u.active_until > naive_now:
+            # Renovación antes de vencer: esa expiración ya no va a ocurrir
+            bump_daily(db, u.active_until.date(), expirations=-1)
+        bump_daily(db, new_until.date(), expirations=1)
+        if u:
+            u.start_date = now.date()
+            u.active_until = (now + timedelta(days=30)).replace(tzinfo=None)
+            u.last_sent_at = None
+        else:
+            db.add(VIPUser(
+                chat_id=chat_id,
+                username=None,
+                start_date=now.date(),
+                active_until=(now + timedelta(days=30)).replace(tzinfo=None),
+                last_sent_at=None
+            ))
+        # 📦 Registrar el pago para métricas
+        db.add(VIPPayment(
+            chat_id=chat_id,
+            mp_payment_id=pid,
+            amount_mxn=amount,
+            currency=p.get("currency_id") or "MXN",
+            status=p.get("status"),
+            approved_at=naive_now,
+        ))
+        db.execute(update(MPInbox).where(MPInbox.mp_payment_id == pid).values(
+            status="done", updated_at=naive_now, processed_at=naive_now, last_error=None))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            if db.execute(select(VIPPayment.id).where(VIPPayment.mp_payment_id == pid)).first():
+                # uq_payment_mp_id: otro worker ya lo aplicó; el rollback deshizo la extensión
+                return False
+            raise  # p.ej. alta simultánea del mismo chat: se reintenta desde el inbox
+    vip_invalidate(chat_id)
+    _mp_link_cache.delete(chat_id)
+    return True
+
+def process_mp_notification(pid: str):
+    """Procesa una notificación del inbox: dedupe → consulta a MP → aplica."""
+    now = now_mx().replace(tzinfo=None)
+    with SessionLocal() as db:
+        # Reclamar la fila: solo un hilo/worker la procesa a la vez
+        claimed = db.execute(
+            update(MPInbox)
+            .where(MPInbox.mp_payment_id == pid, MPInbox.status.in_(("pending", "failed")))
+            .values(status="processing", attempts=MPInbox.attempts + 1, updated_at=now)
+        ).rowcount
+        received_at = db.execute(select(MPInbox.received_at).where(MPInbox.mp_payment_id == pid)).scalar_one_or_none()
+        already = db.execute(select(VIPPayment.id).where(VIPPayment.mp_payment_id == pid)).first()
+        db.commit()
+    if not claimed:
+        return
+    if already:
+        _mp_inbox_finish(pid, "done")
+        _mp_stat("duplicates")
+        return
 
-def pick_vip_gallery(db, chat_id: int) -> Optional[str]:
-    links = read_galleries()
-    if len(links) <= 1:
-        return None
-    return pick_new_from_pool(db, chat_id, links[1:])
+    try:
+        p = mp_fetch_payment(pid)
+    except Exception as e:
+        _mp_inbox_finish(pid, "failed", str(e))
+        _mp_stat("failed")
+        return
+    if not p:
+        _mp_inbox_finish(pid, "failed", "payment not found")
+        _mp_stat("failed")
+        return
+
+    status = p.get("status")
+    amount = p.get("transaction_amount")
+    currency = p.get("currency_id")
+    chat_id = int(p.get("external_reference") or 0)
+    latency = (now_mx().replace(tzinfo=None) - received_at).total_seconds() if received_at else None
+
+    if not (status == "approved" and amount == 50 and currency == "MXN" and chat_id):
+        _mp_inbox_finish(pid, "skipped", f"status={status} amount={amount} {currency}")
+        _mp_stat("skipped", latency)
+        return
+
+    try:
+        applied = apply_payment(pid, p)
+    except IntegrityError as e:
+        _mp_inbox_finish(pid, "failed", str(e))
+        _mp_stat("failed")
+        return
+    if not applied:
+        _mp_inbox_finish(pid, "done")
+        _mp_stat("duplicates")
+        return
+    _mp_stat("applied", latency)
+    tg_send(chat_id, "💋 <b>Payment approved!</b>\n\nYour VIP is now active for <b>30 days</b> ✨")
+    notify_owner(f"💳 New VIP payment from user <b>{chat_id}</b> ✅")
+
+def mp_requeue_stale():
+    """Vuelve a encolar avisos que quedaron pendientes (caída, fallo de MP, otro worker muerto)."""
+    now = now_mx().replace(tzinfo=None)
+    stale = now - timedelta(seconds=MP_INBOX_SCAN_SECS)
+    with SessionLocal() as db:
+        # 'processing' con mucho tiempo sin avanzar = el worker que lo tenía murió
+        db.execute(update(MPInbox).where(
+            MPInbox.status == "processing", MPInbox.updated_at < now - timedelta(minutes=5)
+        ).values(status="failed", updated_at=now, last_error="processing timeout"))
+        pids = db.execute(select(MPInbox.mp_payment_id).where(
+            MPInbox.status.in_(("pending", "failed")),
+            MPInbox.updated_at < stale,
+            MPInbox.attempts < MP_INBOX_MAX_ATTEMPTS,
+        ).order_by(MPInbox.id).limit(100)).scalars().all()
+        db.commit()
+    for pid in pids:
+        _mp_queue.put(pid)
+
+def _mp_worker():
+    ensure_schema_safe()
+    next_scan = 0.0  # el primer pase corre al arrancar: recoge lo que dejó un worker muerto
+    while True:
+        if time.monotonic() >= next_scan:
+            try:
+                mp_requeue_stale()
+            except Exception as e:
+                print("⚠️ MP inbox scan error:", e)
+            next_scan = time.monotonic() + MP_INBOX_SCAN_SECS
+        try:
+            pid = _mp_queue.get(timeout=max(0.0, next_scan - time.monotonic()))
+        except queue.Empty:
+            continue
+        try:
+            process_mp_notification(pid)
+        except Exception as e:
+            traceback.print_exc()
+            recheck_schema_on(e)
+            notify_owner(f"⚠️ Could not process payment {esc(pid)}: <pre>{esc(str(e))}</pre>")
+        finally:
+            _mp_queue.task_done()
+
+def mp_start_worker():
+    """Arranca el hilo del inbox en este proceso (una vez por PID)."""
+    global _mp_worker_pid
+    if MP_WEBHOOK_MODE == "sync" or _mp_worker_pid == os.getpid():
+        return
+    with _mp_worker_lock:
+        if _mp_worker_pid != os.getpid():
+            threading.Thread(target=_mp_worker, name="mp-inbox", daemon=True).start()
+            _mp_worker_pid = os.getpid()
+
+def mp_enqueue(pid: str):
+    if MP_WEBHOOK_MODE == "sync":
+        process_mp_notification(pid)
+        return
+    mp_start_worker()
+    _mp_queue.put(pid)
+
+def mp_queue_depth() -> int:
+    return _mp_queue.qsize() if _mp_worker_pid == os.getpid() else 0
 
-def record_delivery(db, chat_id: int, url: str):
-    db.add(VIPDelivery(chat_id=chat_id, gallery_hash=url_hash(url), url=url, sent_at=now_mx().replace(tzinfo=None)))
+PERF.gauges.update(tg_queue_depth=tg_queue_depth, mp_queue_depth=mp_queue_depth)
+
+# ========= Gallery Logic =========
+_gallery_synced_version = 0
+_gallery_sync_lock = threading.Lock()
+
+def sync_gallery_table(snap: CatalogSnapshot):
+    """Lleva las posiciones del snapshot a vip_galleries (altas, cambios y bajas)."""
+    with SessionLocal() as db:
+        current = {h: (gid, pos) for gid, h, pos in db.execute(
+            select(VIPGallery.id, VIPGallery.gallery_hash, VIPGallery.position))}
+        inserts, updates = [], []
+        for h, i in snap.positions.items():
+            row = current.get(h)
+            if row is None:
+                inserts.append({"gallery_hash": h, "url": snap.urls[i], "position": i})
+            elif row[1] != i:
+                updates.append({"id": row[0], "position": i})
+        for h, (gid, pos) in current.items():
+            if h not in snap.positions and pos != -1:
+                updates.append({"id": gid, "position": -1})
+        if inserts:
+            db.execute(insert(VIPGallery), inserts)
+        if updates:
+            db.execute(update(VIPGallery), updates)
+        db.commit()
+
+def ensure_galleries_synced():
+    global _gallery_synced_version
+    snap = catalog.snapshot()
+    if snap.version == _gallery_synced_version:
+        return
+    with _gallery_sync_lock:
+        if snap.version == _gallery_synced_version:
+            return
+        try:
+            sync_gallery_table(snap)
+        except IntegrityError:
+            # Otro worker insertó las mismas galerías a la vez: reintentar con lo que ya hay
+            sync_gallery_table(snap)
+        _gallery_synced_version = snap.version
+
+def next_gallery_id(chat_id_col, cursor_col):
+    """Expresión SQL con el id de la siguiente galería VIP no entregada.
+
+    Primero busca después del cursor del usuario (un solo salto en el índice en el
+    caso normal); si no hay nada ahí, recorre desde el principio para cubrir galerías
+    insertadas antes del cursor. Sirve tanto con valores como con columnas de VIPUser.
+    """
+    unseen = ~exists().where(
+        VIPDelivery.chat_id == chat_id_col, VIPDelivery.gallery_id == VIPGallery.id
+    ).correlate_except(VIPDelivery)
+    if _legacy_deliveries_pending:
+        # La copia a vip_delivery_log no ha terminado: el formato viejo también cuenta
+        legacy = legacy_deliveries.c
+        unseen = and_(unseen, ~exists().where(
+            legacy.chat_id == chat_id_col, legacy.gallery_hash == VIPGallery.gallery_hash
+        ).correlate_except(legacy_deliveries))
+    after_cursor = (select(VIPGallery.id).where(VIPGallery.position > cursor_col, unseen)
+                    .order_by(VIPGallery.position).limit(1).correlate_except(VIPGallery).scalar_subquery())
+    from_start = (select(VIPGallery.id).where(VIPGallery.position >= 1, unseen)
+                  .order_by(VIPGallery.position).limit(1).correlate_except(VIPGallery).scalar_subquery())
+    return func.coalesce(after_cursor, from_start)
+
+def pick_vip_gallery(db, chat_id: int, cursor: int = 0) -> Optional[VIPGallery]:
+    """Devuelve la primera galería VIP que el usuario no ha recibido."""
+    ensure_galleries_synced()
+    return db.execute(
+        select(VIPGallery).where(VIPGallery.id == next_gallery_id(chat_id, cursor))
+    ).scalar_one_or_none()
+
+def record_delivery(db, chat_id: int, gallery_id: int):
+    now = now_mx()
+    db.add(VIPDelivery(chat_id=chat_id, gallery_id=gallery_id, sent_at=now.replace(tzinfo=None)))
+    bump_daily(db, now.date(), deliveries=1)
+
+# ========= Replies =========
+def muse_text(url: str) -> str:
+    return f"🎁 <b>Your muse today</b>\n{esc(url)} 💋"
+
+def already_sent_text(url: Optional[str]):
+    """Repite el link de hoy: si el mensaje del cron se perdió en un reinicio, aquí se recupera."""
+    if not url:
+        return ALREADY_SENT_REPLY
+    return f"{ALREADY_SENT_TEXT}\n{esc(url)} 💋"
+
+def vip_link_text(link: str) -> str:
+    return f"💳 <b>VIP Access</b>\n\n<b>$50 MXN</b> for <b>30 days</b>.\nComplete your payment here:\n{esc(link)} 💋"
+
+def vip_status_text(u) -> str:
+    if not u:
+        return NO_VIP_TEXT
+    state = "ACTIVE ✅" if is_active(u) else "EXPIRED ❌"
+    return f"👤 <b>VIP Status</b>\n\nStatus: {state}\nDays left: {days_left(u)} 🌙"
+
+def free_gallery_text(url: str) -> str:
+    return f"🖼️ <b>Free Gallery</b>\n{esc(url)} 🌹\n\nUnlock more with <b>VIP</b> 💋"
+
+def expiry_reminder_text(days: int) -> str:
+    when = "today" if days <= 0 else ("tomorrow" if days == 1 else f"in {days} days")
+    return f"⏳ <b>Your VIP ends {when}</b>\n\nTap <b>VIP</b> to renew and keep your daily muse 💋"
+
+EXPIRED_TEXT = "🌙 <b>Your VIP has ended</b>\n\nTap <b>VIP</b> whenever you want to come back ✨"
+
+WELCOME_TEXT = "✨ <b>Welcome to Pure Muse</b>\n\nWhere art meets desire. Try your <b>first gallery for free</b> 🌹\nUnlock <b>30 days</b> of private beauty with <b>VIP</b> 💋"
+PURE_MUSE_TEXT = "🌹 <b>Pure Muse</b>\n\nArtistic sensuality. Use <b>VIP</b> to awaken your muse 🔥"
+NO_VIP_TEXT = "❌ No VIP found. Tap <b>VIP</b> to begin ✨"
+NO_GALLERIES_TEXT = "⚠️ No galleries available yet 🔮"
+FALLBACK_TEXT = "✨ Choose an option below 💫"
+ALREADY_SENT_TEXT = "✨ You already received today’s muse 🌙"
+NO_VIP_GALLERIES_TEXT = "⚠️ No VIP galleries available yet 🔮"
+
+WELCOME_REPLY = StaticReply(WELCOME_TEXT)
+PURE_MUSE_REPLY = StaticReply(PURE_MUSE_TEXT)
+NO_VIP_REPLY = StaticReply(NO_VIP_TEXT)
+NO_GALLERIES_REPLY = StaticReply(NO_GALLERIES_TEXT)
+FALLBACK_REPLY = StaticReply(FALLBACK_TEXT)
+ALREADY_SENT_REPLY = StaticReply(ALREADY_SENT_TEXT)
+NO_VIP_GALLERIES_REPLY = StaticReply(NO_VIP_GALLERIES_TEXT)
+
+def deliver_vip_gallery(db, chat_id: int) -> tuple[str, Optional[str]]:
+    """Entrega la galería VIP del día al chat y confirma la transacción.
+
+    Devuelve (estado, url) con estado "free" | "already" | "none" | "sent". El mensaje
+    lo manda quien llama, ya con la entrega guardada.
+    """
+    # FOR UPDATE: dos "Galleries" del mismo chat en workers distintos se turnan aquí,
+    # y el segundo ya ve el last_sent_at del primero
+    u = db.execute(select(VIPUser).where(VIPUser.chat_id == chat_id).with_for_update()).scalar_one_or_none()
+    if not u or not is_active(u):
+        return "free", None
+    if u.last_sent_at and u.last_sent_at.date() == day_mx():
+        return "already", todays_gallery_url(db, chat_id)
+    gal = pick_vip_gallery(db, chat_id, u.gallery_cursor or 0)
+    if not gal:
+        return "none", None
+    url = gal.url
+    record_delivery(db, chat_id, gal.id)
+    u.gallery_cursor = gal.position
+    u.last_sent_at = now_mx().replace(tzinfo=None)
+    db.commit()
+    return "sent", url
+
+def todays_gallery_url(db, chat_id: int) -> Optional[str]:
+    """La galería que se le entregó hoy al chat (su fila de vip_delivery_log)."""
+    today = day_mx()
+    return db.execute(
+        select(VIPGallery.url).join(VIPDelivery, VIPDelivery.gallery_id == VIPGallery.id)
+        .where(VIPDelivery.chat_id == chat_id, VIPDelivery.sent_at >= datetime(today.year, today.month, today.day))
+        .order_by(VIPDelivery.sent_at.desc()).limit(1)
+    ).scalar_one_or_none()
+
+def gallery_reply(status: str, url: Optional[str], free_url: str):
+    if status == "sent":
+        return muse_text(url)
+    if status == "already":
+        return already_sent_text(url)
+    if status == "none":
+        return NO_VIP_GALLERIES_REPLY
+    return free_gallery_text(free_url)
+
+# ========= Daily delivery =========
+def get_job_run(db, job: str, run_key: str) -> JobRun:
+    """Devuelve (bloqueado) el JobRun de job/run_key, creándolo si no existe."""
+    q = select(JobRun).where(JobRun.job == job, JobRun.run_key == run_key).with_for_update()
+    run = db.execute(q).scalar_one_or_none()
+    if run:
+        return run
+    now = now_mx().replace(tzinfo=None)
+    try:
+        with db.begin_nested():
+            db.add(JobRun(job=job, run_key=run_key, cursor=0, processed=0, status="running",
+                          started_at=now, updated_at=now))
+    except IntegrityError:
+        pass  # otra ejecución lo creó al mismo tiempo
+    return db.execute(q).scalar_one()
+
+def deliver_daily_chunk(run_id: int, today: date) -> tuple[bool, int]:
+    """Entrega la galería del día a un lote de VIPs. Devuelve (terminado, entregas)."""
+    now = now_mx().replace(tzinfo=None)
+    day_start = datetime(today.year, today.month, today.day)
+    with SessionLocal() as db:
+        # El lock sobre el JobRun serializa ejecuciones concurrentes del cron
+        run = db.execute(select(JobRun).where(JobRun.id == run_id).with_for_update()).scalar_one()
+        if run.status == "done":
+            return True, 0
+        rows = db.execute(
+            select(VIPUser.id, VIPUser.chat_id, next_gallery_id(VIPUser.chat_id, VIPUser.gallery_cursor).label("gid"))
+            .where(
+                VIPUser.id > run.cursor,
+                VIPUser.active_until > now,
+                or_(VIPUser.last_sent_at.is_(None), VIPUser.last_sent_at < day_start),
+            )
+            .order_by(VIPUser.id)
+            .limit(DAILY_CHUNK)
+        ).all()
+        if not rows:
+            run.status = "done"
+            run.updated_at = run.finished_at = now
+            db.commit()
+            return True, 0
+
+        gids = {r.gid for r in rows if r.gid}
+        galleries = {gal.id: gal for gal in db.execute(select(VIPGallery).where(VIPGallery.id.in_(gids))).scalars()} if gids else {}
+        deliveries, user_updates, messages = [], [], []
+        for r in rows:
+            gal = galleries.get(r.gid)
+            if not gal:
+                continue  # ya recibió todas las galerías
+            deliveries.append({"chat_id": r.chat_id, "gallery_id": gal.id, "sent_at": now})
+            user_updates.append({"id": r.id, "last_sent_at": now, "gallery_cursor": gal.position})
+            messages.append((r.chat_id, gal.url))
+        if deliveries:
+            db.execute(insert(VIPDelivery), deliveries)
+            db.execute(update(VIPUser), user_updates)
+            bump_daily(db, today, deliveries=len(deliveries))
+        run.cursor = rows[-1].id
+        run.processed += len(deliveries)
+        run.updated_at = now
+        db.commit()
+
+    # Solo se encolan los mensajes de lotes ya confirmados en la DB
+    for chat_id, url in messages:
+        vip_invalidate(chat_id)
+        tg_send(chat_id, muse_text(url))
+    return False, len(deliveries)
+
+def run_daily_delivery(max_seconds: float = DAILY_MAX_SECONDS) -> dict:
+    """Entrega del día para todos los VIP activos, idempotente por day_mx().
+
+    Avanza por lotes con paginación por id y guarda el cursor en job_runs después
+    de cada lote; si se corta (timeout, caída), la siguiente llamada sigue desde ahí.
+    """
+    today = day_mx()
+    ensure_galleries_synced()
+    with SessionLocal() as db:
+        run = get_job_run(db, "daily_delivery", today.isoformat())
+        run_id, done = run.id, run.status == "done"
+        db.commit()
+
+    deadline = time.monotonic() + max_seconds
+    sent = 0
+    retries = 0
+    while not done and time.monotonic() < deadline:
+        try:
+            done, n = deliver_daily_chunk(run_id, today)
+            sent += n
+        except IntegrityError:
+            # Choque con una entrega hecha desde el webhook al mismo tiempo:
+            # al repetir el lote ese usuario ya no aparece como pendiente.
+            retries += 1
+            if retries > 3:
+                raise
+    with SessionLocal() as db:
+        run = db.get(JobRun, run_id)
+        return {"day": str(today), "done": run.status == "done", "sent_now": sent,
+                "sent_total": run.processed, "cursor": run.cursor}
+
+# ========= Delivery migration =========
+_legacy_deliveries_pending = False
+_bootstrap_pid: Optional[int] = None
+_bootstrap_lock = threading.Lock()
+
+def legacy_migration_pending() -> bool:
+    """True si vip_deliveries existe y todavía no está copiada a vip_delivery_log."""
+    if not inspect(engine).has_table(legacy_deliveries.name):
+        return False
+    with SessionLocal() as db:
+        status = db.scalar(select(JobRun.status).where(
+            JobRun.job == "migrate_deliveries", JobRun.run_key == "v1"))
+    return status != "done"
+
+def _bootstrap_worker():
+    global _bootstrap_pid
+    try:
+        if _legacy_deliveries_pending:
+            migrate_legacy_deliveries()
+        days = bootstrap_daily_stats()
+        if days is not None:
+            print(f"✅ vip_daily_stats rebuilt: {days} days")
+    except Exception as e:
+        _bootstrap_pid = None  # el próximo ensure_schema_safe(force=True) lo reintenta
+        traceback.print_exc()
+        notify_owner(f"⚠️ Delivery migration / stats backfill failed:\n<pre>{esc(str(e))}</pre>")
+
+def start_data_bootstrap():
+    """Copia vip_deliveries y llena vip_daily_stats en un hilo aparte (uno por PID)."""
+    global _bootstrap_pid
+    if _bootstrap_pid == os.getpid():
+        return
+    with _bootstrap_lock:
+        if _bootstrap_pid != os.getpid():
+            _bootstrap_pid = os.getpid()
+            threading.Thread(target=_bootstrap_worker, name="data-bootstrap", daemon=True).start()
+
+def migrate_legacy_deliveries(chunk: int = DAILY_CHUNK) -> dict:
+    """Copia vip_deliveries (url + hash por fila) a vip_delivery_log por lotes.
+
+    Reanudable: el último id copiado queda en job_runs. Las galerías que ya no
+    están en galleries.txt se dan de alta en vip_galleries con position -1.
+    """
+    if not inspect(engine).has_table(legacy_deliveries.name):
+        return {"copied": 0, "done": True, "legacy_table": False}
+    ensure_galleries_synced()
+    with SessionLocal() as db:
+        run = get_job_run(db, "migrate_deliveries", "v1")
+        run_id, done = run.id, run.status == "done"
+        db.commit()
+
+    legacy = legacy_deliveries.c
+    copied = 0
+    while not done:
+        with SessionLocal() as db:
+            run = db.execute(select(JobRun).where(JobRun.id == run_id).with_for_update()).scalar_one()
+            now = now_mx().replace(tzinfo=None)
+            rows = db.execute(
+                select(legacy.id, legacy.chat_id, legacy.gallery_hash, legacy.url, legacy.sent_at)
+                .where(legacy.id > run.cursor).order_by(legacy.id).limit(chunk)
+            ).all()
+            if not rows:
+                run.status = "done"
+                run.updated_at = run.finished_at = now
+                db.commit()
+                break
+
+            urls = {r.gallery_hash: r.url for r in rows}
+            gallery_ids = dict(db.execute(
+                select(VIPGallery.gallery_hash, VIPGallery.id).where(VIPGallery.gallery_hash.in_(urls))
+            ).all())
+            missing = [h for h in urls if h not in gallery_ids]
+            if missing:
+                db.execute(insert(VIPGallery), [{"gallery_hash": h, "url": urls[h], "position": -1} for h in missing])
+                gallery_ids.update(db.execute(
+                    select(VIPGallery.gallery_hash, VIPGallery.id).where(VIPGallery.gallery_hash.in_(missing))
+                ).all())
+
+            # Lo que el bot ya registró en el formato nuevo no se vuelve a insertar
+            seen = set(db.execute(
+                select(VIPDelivery.chat_id, VIPDelivery.gallery_id).where(VIPDelivery.chat_id.in_({r.chat_id for r in rows}))
+            ).tuples().all())
+            new = {}
+            for r in rows:
+                key = (r.chat_id, gallery_ids[r.gallery_hash])
+                if key not in seen:
+                    new.setdefault(key, r.sent_at)
+            if new:
+                db.execute(insert(VIPDelivery), [{"chat_id": c, "gallery_id": gid, "sent_at": t} for (c, gid), t in new.items()])
+            run.cursor = rows[-1].id
+            run.processed += len(new)
+            run.updated_at = now
+            db.commit()
+        copied += len(new)
+
+    global _legacy_deliveries_pending
+    with SessionLocal() as db:
+        run = db.get(JobRun, run_id)
+        if run.status == "done":
+            _legacy_deliveries_pending = False
+        return {"copied": copied, "copied_total": run.processed, "done": run.status == "done", "legacy_table": True}
+
+# ========= Expiration sweep =========
+def _notify_expiring(marker, window_start: datetime, window_end: datetime,
+                     text_for: Callable[[datetime], str], deadline: float) -> int:
+    """Avisa por lotes a los VIP con active_until en [window_start, window_end).
+
+    Recorre el índice de active_until y marca cada usuario con el active_until
+    avisado (columna `marker`); una renovación cambia active_until y vuelve a
+    habilitar el aviso. Se envía en este hilo y se marca solo lo que Telegram
+    aceptó: un corte a la mitad repite algún aviso en vez de perderlo.
+    Devuelve cuántos avisos envió.
+    """
+    sent = 0
+    while time.monotonic() < deadline:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(VIPUser.id, VIPUser.chat_id, VIPUser.active_until)
+                .where(
+                    VIPUser.active_until >= window_start,
+                    VIPUser.active_until < window_end,
+                    or_(marker.is_(None), marker != VIPUser.active_until),
+                )
+                .order_by(VIPUser.active_until)
+                .limit(EXPIRY_CHUNK)
+            ).all()
+        if not rows:
+            break
+        done = []
+        for r in rows:
+            if time.monotonic() >= deadline or not tg_send_now(r.chat_id, text_for(r.active_until)):
+                break  # el resto queda sin marcar para el siguiente barrido
+            done.append({"id": r.id, marker.key: r.active_until})
+        if done:
+            with SessionLocal() as db:
+                db.execute(update(VIPUser), done)
+                db.commit()
+        sent += len(done)
+        if len(done) < EXPIRY_CHUNK:
+            break
+    return sent
+
+def archive_expired_deliveries(older_than_days: int, deadline: float) -> int:
+    """Mueve a vip_delivery_archive las entregas de usuarios vencidos hace más de N días.
+
+    Si el usuario renueva sigue desde su gallery_cursor; lo único que pierde es el
+    historial para no repetir galerías al dar la vuelta al catálogo.
+    """
+    cutoff = now_mx().replace(tzinfo=None) - timedelta(days=older_than_days)
+    has_deliveries = exists().where(VIPDelivery.chat_id == VIPUser.chat_id).correlate_except(VIPDelivery)
+    moved = 0
+    while time.monotonic() < deadline:
+        with SessionLocal() as db:
+            chats = db.execute(
+                select(VIPUser.chat_id).where(VIPUser.active_until < cutoff, has_deliveries)
+                .order_by(VIPUser.active_until).limit(EXPIRY_CHUNK)
+            ).scalars().all()
+            if not chats:
+                break
+            now = now_mx().replace(tzinfo=None)
+            db.execute(insert(VIPDeliveryArchive).from_select(
+                ["chat_id", "gallery_id", "sent_at", "archived_at"],
+                select(VIPDelivery.chat_id, VIPDelivery.gallery_id, VIPDelivery.sent_at, literal(now, DateTime))
+                .where(VIPDelivery.chat_id.in_(chats))
+                .where(~exists().where(
+                    VIPDeliveryArchive.chat_id == VIPDelivery.chat_id,
+                    VIPDeliveryArchive.gallery_id == VIPDelivery.gallery_id,
+                ).correlate_except(VIPDeliveryArchive)),
+            ))
+            moved += db.execute(delete(VIPDelivery).where(VIPDelivery.chat_id.in_(chats))).rowcount or 0
+            db.commit()
+    return moved
+
+def purge_delivery_archive(retention_days: int) -> int:
+    """Retención del archivo: borra lo archivado hace más de N días (los totales siguen en vip_daily_stats)."""
+    cutoff = now_mx().replace(tzinfo=None) - timedelta(days=retention_days)
+    with SessionLocal() as db:
+        n = db.execute(delete(VIPDeliveryArchive).where(VIPDeliveryArchive.archived_at < cutoff)).rowcount or 0
+        db.commit()
+    return n
+
+def run_expiration_sweep(remind_days: int = EXPIRY_REMIND_DAYS, archive_days: int = EXPIRY_ARCHIVE_DAYS,
+                         max_seconds: float = DAILY_MAX_SECONDS) -> dict:
+    """Recordatorios antes de vencer, aviso al vencer y (opcional) archivo de entregas viejas.
+
+    Idempotente: se puede llamar cada hora; cada usuario recibe un aviso de cada tipo
+    por periodo pagado.
+    """
+    now = now_mx().replace(tzinfo=None)
+    deadline = time.monotonic() + max_seconds
+    today = now.date()
+    reminders = _notify_expiring(
+        VIPUser.reminded_for, now, now + timedelta(days=remind_days),
+        lambda until: expiry_reminder_text((until.date() - today).days), deadline,
+    ) if remind_days > 0 else 0
+    # Ventana hacia atrás acotada: al activar el job no se avisa a vencidos de hace meses
+    expired = _notify_expiring(
+        VIPUser.expired_notified_for, now - timedelta(days=EXPIRY_NOTICE_DAYS), now,
+        lambda until: EXPIRED_TEXT, deadline,
+    )
+    archived = archive_expired_deliveries(archive_days, deadline) if archive_days > 0 else 0
+    purged = purge_delivery_archive(DELIVERY_ARCHIVE_RETENTION_DAYS) if DELIVERY_ARCHIVE_RETENTION_DAYS > 0 else 0
+    return {"reminders": reminders, "expired": expired, "archived": archived, "archive_purged": purged,
+            "updates_purged": purge_processed_updates()}
+
+# ========= Purge =========
+# Borrados masivos en segundo plano, por lotes cortos con progreso en job_runs.
+# cursor = índice de la tabla en curso dentro de params["tables"].
+PURGE_TABLES = ("deliveries", "archive", "users", "payments")
+_purge_threads: set[int] = set()
+_purge_lock = threading.Lock()
+
+def _purge_batch(db, table: str, chat_id: Optional[int]) -> tuple[int, list[int]]:
+    """Borra hasta PURGE_CHUNK filas de `table` (de un chat o de todos).
+
+    Devuelve (filas borradas, chats a quitar de la caché VIP).
+    """
+    if table in ("deliveries", "archive"):
+        m = VIPDelivery if table == "deliveries" else VIPDeliveryArchive
+        keys = select(m.chat_id, m.gallery_id)
+        if chat_id is not None:
+            keys = keys.where(m.chat_id == chat_id)
+        keys = keys.order_by(m.chat_id, m.gallery_id).limit(PURGE_CHUNK)
+        return db.execute(delete(m).where(tuple_(m.chat_id, m.gallery_id).in_(keys))).rowcount or 0, []
+    if table == "payments":
+        # Los totales por día siguen en vip_daily_stats (backfill-metrics ya no los podrá reconstruir)
+        ids = select(VIPPayment.id)
+        if chat_id is not None:
+            ids = ids.where(VIPPayment.chat_id == chat_id)
+        ids = ids.order_by(VIPPayment.id).limit(PURGE_CHUNK)
+        return db.execute(delete(VIPPayment).where(VIPPayment.id.in_(ids))).rowcount or 0, []
+    q = select(VIPUser.id, VIPUser.chat_id, VIPUser.active_until)
+    if chat_id is not None:
+        q = q.where(VIPUser.chat_id == chat_id)
+    rows = db.execute(q.order_by(VIPUser.id).limit(PURGE_CHUNK)).all()
+    if not rows:
+        return 0, []
+    now = now_mx().replace(tzinfo=None)
+    for day, n in Counter(r.active_until.date() for r in rows if r.active_until > now).items():
+        bump_daily(db, day, expirations=-n)  # ya no vencerán
+    db.execute(delete(VIPUser).where(VIPUser.id.in_([r.id for r in rows])))
+    return len(rows), [r.chat_id for r in rows]
+
+def create_purge(chat_id: Optional[int] = None, payments: bool = False) -> int:
+    """Registra un job de borrado (todo, o un solo chat) y devuelve su id."""
+    tables = [t for t in PURGE_TABLES if payments or t != "payments"]
+    params = {"chat_id": chat_id, "tables": tables, "deleted": {t: 0 for t in tables}}
+    now = now_mx().replace(tzinfo=None)
+    with SessionLocal() as db:
+        run = JobRun(job="purge", run_key=f"{now:%Y%m%d%H%M%S}-{os.urandom(3).hex()}", cursor=0, processed=0,
+                     status="running", params=json.dumps(params), started_at=now, updated_at=now)
+        db.add(run)
+        db.commit()
+        return run.id
+
+def run_purge(run_id: int):
+    """Avanza el job lote por lote hasta terminar, o hasta que lo cancelen."""
+    while True:
+        try:
+            with SessionLocal() as db:
+                # El lock sobre el JobRun serializa este hilo con otro worker y con cancel/resume
+                run = db.execute(select(JobRun).where(JobRun.id == run_id).with_for_update()).scalar_one()
+                if run.status != "running":
+                    return
+                params = json.loads(run.params)
+                now = now_mx().replace(tzinfo=None)
+                if run.cursor >= len(params["tables"]):
+                    run.status = "done"
+                    run.updated_at = run.finished_at = now
+                    db.commit()
+                    return
+                table = params["tables"][run.cursor]
+                n, chats = _purge_batch(db, table, params.get("chat_id"))
+                if n:
+                    params["deleted"][table] += n
+                    run.processed += n
+                    run.params = json.dumps(params)
+                else:
+                    run.cursor += 1
+                run.updated_at = now
+                db.commit()
+        except Exception as e:
+            traceback.print_exc()
+            recheck_schema_on(e)
+            with SessionLocal() as db:
+                db.execute(update(JobRun).where(JobRun.id == run_id)
+                           .values(status="failed", updated_at=now_mx().replace(tzinfo=None)))
+                db.commit()
+            notify_owner(f"🔥 Purge job {run_id} failed (resume with /admin/purge/{run_id}/resume):\n<pre>{esc(str(e))}</pre>")
+            return
+        for chat_id in chats:
+            vip_invalidate(chat_id)
+        if n:
+            time.sleep(PURGE_PAUSE_SECS)
+
+def _purge_thread(run_id: int):
+    try:
+        run_purge(run_id)
+    finally:
+        with _purge_lock:
+            _purge_threads.discard(run_id)
+
+def start_purge(run_id: int) -> bool:
+    """Corre el job en un hilo de este proceso (uno por job)."""
+    with _purge_lock:
+        if run_id in _purge_threads:
+            return False
+        _purge_threads.add(run_id)
+    threading.Thread(target=_purge_thread, args=(run_id,), name=f"purge-{run_id}", daemon=True).start()
+    return True
+
+def purge_status(run: JobRun) -> dict:
+    params = json.loads(run.params or "{}")
+    tables = params.get("tables", [])
+    return {"job_id": run.id, "status": run.status, "chat_id": params.get("chat_id"),
+            "table": tables[run.cursor] if run.cursor < len(tables) else None,
+            "deleted": params.get("deleted", {}), "deleted_total": run.processed,
+            "started_at": str(run.started_at), "updated_at": str(run.updated_at),
+            "finished_at": str(run.finished_at) if run.finished_at else None,
+            "running_here": run.id in _purge_threads}
 
 # ========= Flask App =========
 app = Flask(__name__)
@@ -218,161 +2139,433 @@ def root():
 def health():
     return "ok", 200
 
+
+@app.before_request
+def _db_counter_reset():
+    _db_local.queries = 0
+    g.perf_t0 = time.perf_counter()
+    PERF.inflight_add("http", {"route": _perf_route()}, 1)
+
+def _perf_route() -> str:
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.teardown_request
+def _db_session_close(exc):
+    db = g.pop("db", None)
+    if db is not None:
+        db.close()
+
+@app.teardown_request
+def _perf_record(exc):
+    t0 = g.pop("perf_t0", None)
+    if t0 is None:
+        return
+    route = _perf_route()
+    PERF.inflight_add("http", {"route": route}, -1)
+    labels = {"route": route}
+    if route == "/telegram":
+        labels["branch"] = g.get("perf_branch", "none")
+    error = exc is not None or g.get("perf_error", False) or g.get("perf_status", 200) >= 500
+    PERF.observe("http", labels, time.perf_counter() - t0, error)
+    PERF.flush()
+
+@app.after_request
+def _db_counter_record(resp):
+    n = getattr(_db_local, "queries", 0)
+    resp.headers["X-DB-Queries"] = str(n)
+    g.perf_status = resp.status_code
+    with _db_stats_lock:
+        st = DB_STATS.setdefault(request.endpoint or "unknown", [0, 0])
+        st[0] += 1
+        st[1] += n
+    return resp
+
 @app.get("/testdb")
 def testdb():
-    ensure_schema_safe()
+    if not ensure_schema_safe(force=True):
+        return "❌ DB schema check failed", 500
     return "✅ DB ready", 200
+
 @app.post("/mp/webhook")
 def mp_webhook():
     if request.args.get("secret") != CRON_TOKEN:
         return "forbidden", 403
+    ensure_schema_safe()
+    mp_start_worker()  # aunque el aviso sea repetido: el barrido recoge pendientes huérfanos
 
     d = request.get_json(silent=True) or {}
     pid = d.get("data", {}).get("id") or d.get("id")
     if not pid:
         return "missing id", 400
 
-    p = mp_fetch_payment(pid)
-    if not p:
-        return "not found", 404
+    # Solo se anota la notificación; el pago se consulta y aplica en segundo plano
+    try:
+        with db_session() as db:
+            queued = mp_inbox_record(db, str(pid))
+    except Exception as e:
+        recheck_schema_on(e)
+        traceback.print_exc()
+        return "error", 500  # MP reintentará
+    if queued:
+        mp_enqueue(str(pid))
+    return "ok", 200
 
-    status = p.get("status")
-    amount = p.get("transaction_amount")
-    currency = p.get("currency_id")
-    chat_id = int(p.get("external_reference") or 0)
 
-    if status == "approved" and amount == 50 and currency == "MXN" and chat_id:
-        ensure_schema_safe()
-        with SessionLocal() as db:
-            now = now_mx()
-            u = db.execute(select(VIPUser).where(VIPUser.chat_id == chat_id)).scalar_one_or_none()
-            if u:
-                u.start_date = now.date()
-                u.active_until = (now + timedelta(days=30)).replace(tzinfo=None)
-                u.last_sent_at = None
-            else:
-                db.add(VIPUser(
-                    chat_id=chat_id,
-                    username=None,
-                    start_date=now.date(),
-                    active_until=(now + timedelta(days=30)).replace(tzinfo=None),
-                    last_sent_at=None
-                ))
+# ========= Telegram Webhook =========
+# Router de comandos: texto (en minúsculas) → (etiqueta para métricas, handler).
+# Un handler recibe (chat_id, db) y devuelve lo que hay que contestar: un str, un
+# StaticReply o None si ya contestó él mismo. `db` es la sesión del lote en modo
+# polling o la del request en el webhook (None: el handler abre la suya).
+class TGRoute(NamedTuple):
+    branch: str
+    handler: Callable
+    static: bool = False  # respuesta fija, sin efectos: un duplicado no necesita guardia en DB
+
+TG_ROUTES: dict[str, TGRoute] = {}
+
+def tg_route(*aliases: str, branch: str, static: bool = False):
+    def register(fn):
+        for alias in aliases:
+            TG_ROUTES[alias.lower()] = TGRoute(branch, fn, static)
+        return fn
+    return register
+
+def tg_match(txt: str) -> TGRoute:
+    key = txt.strip().lower()
+    if key.startswith("/"):
+        key = key.split("@", 1)[0]  # "/start@PureMuseBot" en grupos
+    return TG_ROUTES.get(key) or TG_FALLBACK
+
+@tg_route("/start", "menu", "start", branch="start", static=True)
+def cmd_start(chat_id: int, db):
+    return WELCOME_REPLY
+
+@tg_route("pure muse", "/puremuse", branch="pure_muse", static=True)
+def cmd_pure_muse(chat_id: int, db):
+    return PURE_MUSE_REPLY
+
+@tg_route("vip", "/vip", branch="vip")
+def cmd_vip(chat_id: int, db):
+    return vip_link_text(mp_create_link(chat_id))
+
+@tg_route("vip status", "/status", branch="vip_status")
+def cmd_vip_status(chat_id: int, db):
+    rec = vip_lookup(chat_id)
+    return vip_status_text(rec) if rec else NO_VIP_REPLY
+
+@tg_route("galleries", "/galleries", branch="galleries")
+def cmd_galleries(chat_id: int, db):
+    free_gallery = catalog.free
+    if not free_gallery:
+        return NO_GALLERIES_REPLY
+    rec = vip_lookup(chat_id)
+    if not rec or not is_active(rec):
+        return free_gallery_text(free_gallery)
+    if rec.last_sent_at and rec.last_sent_at.date() == day_mx():
+        if db is not None:
+            return already_sent_text(todays_gallery_url(db, chat_id))
+        with db_session() as s:
+            return already_sent_text(todays_gallery_url(s, chat_id))
+
+    # La caché puede venir de otro worker: se confirma con la fila real. Solo la
+    # entrega va bajo el lock; el commit suelta el FOR UPDATE aunque no haya envío
+    with chat_lock(chat_id):
+        if db is None:
+            with db_session() as s:
+                status, url = deliver_vip_gallery(s, chat_id)
+                s.commit()
+        else:
+            status, url = deliver_vip_gallery(db, chat_id)
             db.commit()
+    vip_invalidate(chat_id)
+    return gallery_reply(status, url, free_gallery)
 
-        tg_send(chat_id, "💋 <b>Payment approved!</b>\n\nYour VIP is now active for <b>30 days</b> ✨")
-        notify_owner(f"💳 New VIP payment from user <b>{chat_id}</b> ✅")
+TG_FALLBACK = TGRoute("other", lambda chat_id, db: FALLBACK_REPLY, static=True)
 
-        # 📦 Registrar el pago para métricas
-        try:
-            ensure_schema_safe()
-            with SessionLocal() as db:
-                existing = db.execute(
-                    select(VIPPayment).where(VIPPayment.mp_payment_id == str(pid))
-                ).scalar_one_or_none()
-                if not existing:
-                    db.add(VIPPayment(
-                        chat_id=chat_id,
-                        mp_payment_id=str(pid),
-                        amount_mxn=int(amount or 0),
-                        currency=currency or "MXN",
-                        status=status,
-                        approved_at=now_mx().replace(tzinfo=None),
-                    ))
-                    db.commit()
-        except Exception as e:
-            notify_owner(f"⚠️ Could not record payment {pid}: <pre>{esc(str(e))}</pre>")
+def send_reply(chat_id: int, reply, webhook_reply: bool = False) -> Optional[bytes]:
+    """Manda la respuesta de un handler. Con webhook_reply, las respuestas fijas se
+    devuelven como cuerpo para el webhook en vez de hacer una petición a Telegram."""
+    if reply is None:
+        return None
+    if webhook_reply and isinstance(reply, StaticReply):
+        return tg_webhook_body(chat_id, reply.tail)
+    tg_send(chat_id, reply)
+    return None
 
-    return "ok", 200
+# Telegram reintenta los webhooks lentos: el mismo update puede llegar dos veces,
+# incluso a workers distintos. Capa 1: ventana en memoria (gratis). Capa 2: PK en
+# tg_updates, solo para rutas con efectos. La entrega de galería de un mismo chat va
+# de una en una: FOR UPDATE sobre VIPUser entre workers y chat_lock dentro del proceso
+# (SQLite ignora FOR UPDATE). Lo demás, incluidas las llamadas a MP, corre sin lock.
+class RecentIds:
+    """Conjunto acotado de los últimos ids vistos (thread-safe)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._ids: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key) -> bool:
+        """Registra `key`; False si ya estaba."""
+        with self._lock:
+            if key in self._ids:
+                return False
+            self._ids[key] = None
+            if len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+recent_updates = RecentIds(TG_DEDUPE_WINDOW)
+_chat_locks = [threading.Lock() for _ in range(64)]
+
+def chat_lock(chat_id: int) -> threading.Lock:
+    """Lock por chat (striped) para la entrega de galería: solo cubre trabajo en DB."""
+    return _chat_locks[chat_id % len(_chat_locks)]
+
+def claim_update(db, update_id: int) -> bool:
+    """Anota el update en tg_updates dentro de la transacción de `db`; False si ya estaba."""
+    try:
+        with db.begin_nested():
+            db.add(ProcessedUpdate(update_id=update_id, received_at=now_mx().replace(tzinfo=None)))
+        return True
+    except IntegrityError:
+        return False
 
+def release_update(update_id: int):
+    """Olvida un update que falló, para que el reintento de Telegram sí se atienda."""
+    recent_updates.discard(update_id)
+    with db_session() as db:
+        db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_id == update_id))
+        db.commit()
+
+def tg_dedupe(update_id: Optional[int], route: TGRoute, db=None) -> Optional[str]:
+    """None si hay que atender el update; si no, en qué capa se detectó el duplicado."""
+    if update_id is None:
+        return None
+    if not recent_updates.add(update_id):
+        return "memory"
+    if route.static:
+        return None
+    if db is not None:
+        claimed = claim_update(db, update_id)
+    else:
+        with db_session() as s:
+            claimed = claim_update(s, update_id)
+            s.commit()
+    return None if claimed else "db"
+
+def purge_processed_updates(days: int = TG_DEDUPE_DAYS) -> int:
+    cutoff = now_mx().replace(tzinfo=None) - timedelta(days=days)
+    with SessionLocal() as db:
+        n = db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.received_at < cutoff)).rowcount or 0
+        db.commit()
+    return n
+
+_updates_pruned_at = 0.0
+_updates_prune_lock = threading.Lock()
+
+def maybe_purge_processed_updates():
+    """Poda tg_updates desde el webhook o el poller, sin depender del cron del barrido."""
+    global _updates_pruned_at
+    if time.monotonic() < _updates_pruned_at or not _updates_prune_lock.acquire(blocking=False):
+        return
+    try:
+        _updates_pruned_at = time.monotonic() + TG_DEDUPE_PRUNE_SECS
+        purge_processed_updates()
+    except Exception as e:
+        print("⚠️ tg_updates prune error:", e)
+    finally:
+        _updates_prune_lock.release()
+
+def tg_message(update: dict) -> tuple[Optional[int], str]:
+    """(chat_id, texto) de un update de Telegram; chat_id None si no es un mensaje."""
+    msg = update.get("message") or update.get("edited_message")
+    if not msg:
+        return None, ""
+    chat_id = (msg.get("chat") or {}).get("id")
+    return chat_id, (msg.get("text") or "").strip()
 
-# ========= Telegram Webhook =========
 @app.post("/telegram")
 def telegram_webhook():
     ensure_schema_safe()
     d = request.get_json(silent=True) or {}
-    msg = d.get("message") or d.get("edited_message")
-    if not msg:
-        return jsonify(ok=True)
-
-    chat = msg.get("chat") or {}
-    chat_id = chat.get("id")
+    chat_id, txt = tg_message(d)
     if not chat_id:
         return jsonify(ok=True)
 
-    txt = (msg.get("text") or "").strip()
+    route = tg_match(txt)
+    g.perf_branch = route.branch
+    update_id = d.get("update_id")
 
     try:
-        if txt.lower() in ("/start", "menu"):
-            tg_send(chat_id, "✨ <b>Welcome to Pure Muse</b>\n\nWhere art meets desire. Try your <b>first gallery for free</b> 🌹\nUnlock <b>30 days</b> of private beauty with <b>VIP</b> 💋")
-            return jsonify(ok=True)
-
-        if txt == "Pure Muse":
-            tg_send(chat_id, "🌹 <b>Pure Muse</b>\n\nArtistic sensuality. Use <b>VIP</b> to awaken your muse 🔥")
-            return jsonify(ok=True)
-
-        if txt == "VIP":
-            link = mp_create_link(chat_id)
-            tg_send(chat_id, f"💳 <b>VIP Access</b>\n\n<b>$50 MXN</b> for <b>30 days</b>.\nComplete your payment here:\n{esc(link)} 💋")
-            return jsonify(ok=True)
-
-        if txt == "VIP status":
-            ensure_schema_safe()
-            with SessionLocal() as db:
-                try:
-                    u = db.execute(select(VIPUser).where(VIPUser.chat_id == chat_id)).scalar_one_or_none()
-                except (ProgrammingError, OperationalError):
-                    ensure_schema_safe()
-                    u = None
-                if not u:
-                    tg_send(chat_id, "❌ No VIP found. Tap <b>VIP</b> to begin ✨")
-                else:
-                    state = "ACTIVE ✅" if is_active(u) else "EXPIRED ❌"
-                    tg_send(chat_id, f"👤 <b>VIP Status</b>\n\nStatus: {state}\nDays left: {days_left(u)} 🌙")
-            return jsonify(ok=True)
-
-        if txt == "Galleries":
-            links = read_galleries()
-            if not links:
-                tg_send(chat_id, "⚠️ No galleries available yet 🔮")
+        with db_session() as db:
+            dup = tg_dedupe(update_id, route, db)
+            db.commit()  # el claim queda visible para los otros workers
+            if dup:
+                g.perf_branch = "duplicate"
+                PERF.inc("tg_duplicate", {"layer": dup})
                 return jsonify(ok=True)
-
-            free_gallery = links[0]
-            ensure_schema_safe()
-            with SessionLocal() as db:
-                try:
-                    u = db.execute(select(VIPUser).where(VIPUser.chat_id == chat_id)).scalar_one_or_none()
-                except (ProgrammingError, OperationalError):
-                    ensure_schema_safe()
-                    u = None
-
-                if not u or not is_active(u):
-                    tg_send(chat_id, f"🖼️ <b>Free Gallery</b>\n{esc(free_gallery)} 🌹\n\nUnlock more with <b>VIP</b> 💋")
-                    return jsonify(ok=True)
-
-                today = day_mx()
-                if u.last_sent_at and u.last_sent_at.date() == today:
-                    tg_send(chat_id, "✨ You already received today’s muse 🌙")
-                else:
-                    vip_link = pick_vip_gallery(db, chat_id)
-                    if not vip_link:
-                        tg_send(chat_id, "⚠️ No VIP galleries available yet 🔮")
-                    else:
-                        tg_send(chat_id, f"🎁 <b>Your muse today</b>\n{esc(vip_link)} 💋")
-                        record_delivery(db, chat_id, vip_link)
-                        u.last_sent_at = now_mx().replace(tzinfo=None)
-                        db.commit()
-            return jsonify(ok=True)
-
-        tg_send(chat_id, "✨ Choose an option below 💫")
-        return jsonify(ok=True)
-
+            reply = route.handler(chat_id, db)
+            db.commit()  # suelta locks y conexión antes de hablar con Telegram
+            body = send_reply(chat_id, reply, TG_WEBHOOK_REPLY)
+        if body:
+            return Response(body, mimetype="application/json")
     except Exception as e:
+        g.perf_error = True
         err = traceback.format_exc()
+        if update_id is not None:
+            try:
+                release_update(update_id)
+            except Exception as release_err:
+                # Con la DB caída el DELETE también falla: que igual se avise y se revise el esquema
+                print("⚠️ release_update error:", release_err)
+        recheck_schema_on(e)
         notify_owner(f"🔥 Telegram handler crashed:\n<pre>{esc(err)}</pre>")
-        return jsonify(ok=True)
-        
+    finally:
+        maybe_purge_processed_updates()
+    return jsonify(ok=True)
+
+# ========= Telegram polling =========
+# Alternativa al webhook, no un proceso que corra junto a él: Telegram no entrega
+# por getUpdates mientras haya webhook. Sirve para vaciar el backlog tras una
+# caída o para desplegar sin URL pública:
+#   flask --app bot poll --take-over --drain   # apaga el webhook y vacía lo pendiente
+#   flask --app bot webhook on                 # de vuelta al webhook
+TG_OFFSET_KEY = "tg_update_offset"
+
+def get_state(db, key: str) -> Optional[str]:
+    row = db.get(BotState, key)
+    return row.value if row else None
+
+def set_state(db, key: str, value: str):
+    now = now_mx().replace(tzinfo=None)
+    row = db.get(BotState, key)
+    if row is None:
+        db.add(BotState(key=key, value=value, updated_at=now))
+    else:
+        row.value = value
+        row.updated_at = now
+
+def tg_api(endpoint: str, /, http_timeout: float = 15, **params) -> dict:
+    r = TG_HTTP.post(endpoint, json=params, timeout=http_timeout)
+    try:
+        body = r.json()
+    except ValueError:
+        body = {"ok": False, "description": r.text[:200]}
+    body.setdefault("status_code", r.status_code)
+    return body
+
+def tg_set_webhook() -> dict:
+    return tg_api(TG_SET_WEBHOOK_URL, url=f"{BASE_URL}/telegram",
+                  allowed_updates=["message", "edited_message"])
+
+def tg_delete_webhook(drop_pending: bool = False) -> dict:
+    return tg_api(TG_DELETE_WEBHOOK_URL, drop_pending_updates=drop_pending)
+
+def tg_webhook_info() -> dict:
+    return tg_api(TG_GET_WEBHOOK_INFO_URL)
+
+def prime_vip_cache(db, chat_ids):
+    """Carga de una vez el estado VIP de todos los chats del lote en la caché."""
+    found = {}
+    for row in db.execute(
+        select(VIPUser.chat_id, VIPUser.active_until, VIPUser.last_sent_at).where(VIPUser.chat_id.in_(chat_ids))
+    ):
+        found[row.chat_id] = VIPRecord(*row)
+    for chat_id in chat_ids:
+        rec = found.get(chat_id)
+        vip_cache.set(chat_id, rec, ttl=VIP_CACHE_TTL if rec else VIP_CACHE_NEG_TTL)
+
+def process_updates(updates: list[dict]) -> Optional[int]:
+    """Atiende un lote de getUpdates con una sola sesión. Devuelve el siguiente offset."""
+    if not updates:
+        return None
+    by_chat: dict[int, list[tuple[Optional[int], str]]] = {}
+    for upd in updates:
+        chat_id, txt = tg_message(upd)
+        if chat_id:
+            by_chat.setdefault(chat_id, []).append((upd.get("update_id"), txt))
+    next_offset = max(u["update_id"] for u in updates) + 1
+
+    with PERF.track("tg_batch", source="poll"), SessionLocal() as db:
+        if by_chat:
+            prime_vip_cache(db, list(by_chat))
+        for chat_id, texts in by_chat.items():
+            for update_id, txt in texts:
+                route = tg_match(txt)
+                t0 = time.perf_counter()
+                error = False
+                try:
+                    # Tras una caída el lote se repite: lo ya atendido se salta
+                    dup = tg_dedupe(update_id, route, db)
+                    if dup:
+                        PERF.inc("tg_duplicate", {"layer": dup})
+                        continue
+                    send_reply(chat_id, route.handler(chat_id, db))
+                    db.commit()
+                except Exception as e:
+                    error = True
+                    db.rollback()
+                    recent_updates.discard(update_id)
+                    recheck_schema_on(e)
+                    notify_owner(f"🔥 Telegram handler crashed:\n<pre>{esc(traceback.format_exc())}</pre>")
+                PERF.observe("tg_update", {"source": "poll", "branch": route.branch},
+                             time.perf_counter() - t0, error)
+        # El offset se guarda después de atender el lote: si el worker cae a la mitad,
+        # Telegram vuelve a entregar el lote completo (al menos una vez).
+        set_state(db, TG_OFFSET_KEY, str(next_offset))
+        db.commit()
+    return next_offset
+
+def run_poller(drain: bool = False):
+    """Bucle de getUpdates. Con drain=True termina cuando ya no quedan updates pendientes."""
+    with SessionLocal() as db:
+        offset = int(get_state(db, TG_OFFSET_KEY) or 0)
+    backoff = 1.0
+    handled = 0
+    while True:
+        timeout = 0 if drain else TG_POLL_TIMEOUT
+        try:
+            with PERF.track("outbound", target="tg_get_updates") as t:
+                body = tg_api(TG_GET_UPDATES_URL, http_timeout=timeout + 10, offset=offset, limit=TG_POLL_LIMIT,
+                              timeout=timeout, allowed_updates=["message", "edited_message"])
+                t.error = not body.get("ok")
+        except requests.RequestException as e:
+            print("⚠️ getUpdates error:", e)
+            body = {"ok": False, "status_code": 0}
+        if not body.get("ok"):
+            if body.get("status_code") == 409:
+                # Alguien activó el webhook: el webhook manda, el poller se retira
+                raise click.ClickException("getUpdates conflict: webhook is set (flask --app bot webhook off)")
+            if body.get("status_code") == 429:
+                backoff = max(backoff, float((body.get("parameters") or {}).get("retry_after", backoff)))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+            continue
+        backoff = 1.0
+        updates = body.get("result") or []
+        if not updates:
+            if drain:
+                return handled
+            continue
+        offset = process_updates(updates)
+        handled += len(updates)
+        maybe_purge_processed_updates()
+        PERF.flush()
+
 # ======= ADMIN ENDPOINTS (safe) =======
+@app.post("/admin/galleries/reload")
+def admin_galleries_reload():
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    catalog.reload(force=True)
+    snap = catalog.snapshot()
+    return jsonify(ok=True, galleries=len(snap.urls), version=snap.version), 200
+
 @app.get("/admin/delete_user")
 def admin_delete_user():
     if request.args.get("secret") != CRON_TOKEN:
@@ -383,33 +2576,95 @@ def admin_delete_user():
 
     ensure_schema_safe()
     try:
+        # Un solo chat: pocos lotes, se corre en línea con el mismo job que el borrado total
+        run_id = create_purge(chat_id=chat_id, payments=request.args.get("payments") == "1")
+        run_purge(run_id)
         with SessionLocal() as db:
-            # Borrar entregas primero (si existen)
-            d1 = db.execute(delete(VIPDelivery).where(VIPDelivery.chat_id == chat_id)).rowcount
-            d2 = db.execute(delete(VIPUser).where(VIPUser.chat_id == chat_id)).rowcount
-            db.commit()
-        return jsonify(ok=True, deleted=(d1 or 0) + (d2 or 0)), 200
+            st = purge_status(db.get(JobRun, run_id))
+        return jsonify(ok=st["status"] == "done", deleted=st["deleted_total"], job=st), 200
     except Exception as e:
         import traceback; traceback.print_exc()
+        recheck_schema_on(e)
         return jsonify(ok=False, error=str(e)), 500
 
 
-@app.get("/admin/clear_all")
+@app.post("/admin/clear_all")
 def admin_clear_all():
     if request.args.get("secret") != CRON_TOKEN:
         return "forbidden", 403
     ensure_schema_safe()
     try:
-        with SessionLocal() as db:
-            d1 = db.execute(delete(VIPDelivery)).rowcount
-            d2 = db.execute(delete(VIPUser)).rowcount
-            db.commit()
-        return jsonify(ok=True, cleared_users=(d2 or 0), cleared_deliveries=(d1 or 0)), 200
+        run_id = create_purge(payments=request.args.get("payments") == "1")
+        start_purge(run_id)
+        return jsonify(ok=True, job_id=run_id, status_url=f"/admin/purge/{run_id}"), 202
     except Exception as e:
         import traceback; traceback.print_exc()
+        recheck_schema_on(e)
         return jsonify(ok=False, error=str(e)), 500
 
 
+@app.post("/admin/purge")
+def admin_purge_start():
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    run_id = create_purge(chat_id=request.args.get("chat_id", type=int), payments=request.args.get("payments") == "1")
+    start_purge(run_id)
+    return jsonify(ok=True, job_id=run_id, status_url=f"/admin/purge/{run_id}"), 202
+
+
+def _purge_run_or_404(job_id: int):
+    with SessionLocal() as db:
+        run = db.get(JobRun, job_id)
+    return run if run and run.job == "purge" else None
+
+
+@app.get("/admin/purge/<int:job_id>")
+def admin_purge_status(job_id):
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    run = _purge_run_or_404(job_id)
+    if run is None:
+        return jsonify(ok=False, error="job not found"), 404
+    return jsonify(ok=True, **purge_status(run)), 200
+
+
+@app.post("/admin/purge/<int:job_id>/cancel")
+def admin_purge_cancel(job_id):
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    with SessionLocal() as db:
+        # Espera a que termine el lote en curso (lock del JobRun) y lo detiene antes del siguiente
+        n = db.execute(update(JobRun).where(JobRun.id == job_id, JobRun.job == "purge", JobRun.status == "running")
+                       .values(status="cancelled", updated_at=now_mx().replace(tzinfo=None))).rowcount
+        db.commit()
+    run = _purge_run_or_404(job_id)
+    if run is None:
+        return jsonify(ok=False, error="job not found"), 404
+    return jsonify(ok=bool(n), **purge_status(run)), 200 if n else 409
+
+
+@app.post("/admin/purge/<int:job_id>/resume")
+def admin_purge_resume(job_id):
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    with SessionLocal() as db:
+        # "running" también: el worker que lo corría pudo morir a la mitad
+        n = db.execute(update(JobRun).where(JobRun.id == job_id, JobRun.job == "purge",
+                                            JobRun.status.in_(("running", "cancelled", "failed")))
+                       .values(status="running", updated_at=now_mx().replace(tzinfo=None))).rowcount
+        db.commit()
+    if n:
+        start_purge(job_id)
+    run = _purge_run_or_404(job_id)
+    if run is None:
+        return jsonify(ok=False, error="job not found"), 404
+    return jsonify(ok=bool(n), **purge_status(run)), 202 if n else 409
+
+
 @app.get("/admin/db_status")
 def admin_db_status():
     if request.args.get("secret") != CRON_TOKEN:
@@ -418,13 +2673,32 @@ def admin_db_status():
     try:
         with SessionLocal() as db:
             users = db.execute(select(func.count(VIPUser.id))).scalar_one()
-            deliveries = db.execute(select(func.count(VIPDelivery.id))).scalar_one()
+            deliveries = db.execute(select(func.count()).select_from(VIPDelivery)).scalar_one()
             last_backup = db.execute(select(func.max(VIPDelivery.sent_at))).scalar_one_or_none()
-        return jsonify(ok=True, users=users, deliveries=deliveries, last_backup=str(last_backup)), 200
+        with _db_stats_lock:
+            queries_per_request = {k: round(q / r, 2) for k, (r, q) in DB_STATS.items() if r}
+        return jsonify(ok=True, users=users, deliveries=deliveries, last_backup=str(last_backup),
+                       queries_per_request=queries_per_request), 200
     except Exception as e:
         import traceback; traceback.print_exc()
+        recheck_schema_on(e)
         return jsonify(ok=False, error=str(e)), 500
 
+@app.get("/admin/db/pool")
+def admin_db_pool():
+    """Estado del pool de este worker (cada proceso de gunicorn tiene el suyo)."""
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    pool = engine.pool
+    state = {"class": type(pool).__name__, "pid": os.getpid()}
+    if isinstance(pool, QueuePool):
+        state.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                     overflow=max(0, pool.overflow()), max_overflow=DB_MAX_OVERFLOW)
+    settings = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT,
+                "pool_recycle": DB_POOL_RECYCLE, "pre_ping": DB_PRE_PING, "pgbouncer": DB_PGBOUNCER,
+                "web_threads": WEB_THREADS}
+    return jsonify(ok=True, pool=state, settings=settings, stats=POOL_STATS.snapshot()), 200
+
 @app.get("/admin/metrics/overview")
 def metrics_overview():
     if request.args.get("secret") != CRON_TOKEN:
@@ -433,48 +2707,43 @@ def metrics_overview():
     try:
         today = day_mx()
         last_30 = today - timedelta(days=30)
+        now = now_mx().replace(tzinfo=None)
 
         with SessionLocal() as db:
-            all_users = list(db.execute(select(VIPUser)).scalars())
-            users_total = len(all_users)
-            users_active = sum(1 for u in all_users if is_active(u))
+            users_total = db.execute(select(func.count(VIPUser.id))).scalar_one() or 0
+            users_active = db.execute(
+                select(func.count(VIPUser.id)).where(VIPUser.active_until > now)
+            ).scalar_one() or 0
             users_expired = users_total - users_active
 
-            deliveries_total = db.execute(select(func.count(VIPDelivery.id))).scalar_one() or 0
-            deliveries_today = db.execute(
-                select(func.count(VIPDelivery.id)).where(func.date(VIPDelivery.sent_at) == today)
-            ).scalar_one() or 0
+            totals = db.execute(select(
+                func.coalesce(func.sum(DailyStat.deliveries), 0),
+                func.coalesce(func.sum(DailyStat.payments), 0),
+                func.coalesce(func.sum(DailyStat.revenue_mxn), 0),
+                func.coalesce(func.sum(case((DailyStat.day >= last_30, DailyStat.revenue_mxn), else_=0)), 0),
+            )).one()
+            deliveries_total, payments_total_count, revenue_mxn_total, revenue_mxn_30d = (int(v) for v in totals)
+            today_row = db.get(DailyStat, today)
             last_delivery_at = db.execute(select(func.max(VIPDelivery.sent_at))).scalar_one_or_none()
 
-            payments_total_count = db.execute(select(func.count(VIPPayment.id))).scalar_one() or 0
-            revenue_mxn_total = db.execute(select(func.coalesce(func.sum(VIPPayment.amount_mxn), 0))).scalar_one() or 0
-            revenue_mxn_30d = db.execute(
-                select(func.coalesce(func.sum(VIPPayment.amount_mxn), 0)).where(
-                    func.date(VIPPayment.approved_at) >= last_30
-                )
-            ).scalar_one() or 0
-
-            new_vip_today = db.execute(
-                select(func.count(VIPPayment.id)).where(func.date(VIPPayment.approved_at) == today)
-            ).scalar_one() or 0
-            expiring_today = sum(1 for u in all_users if u.active_until and u.active_until.date() == today)
-
         return jsonify(
             ok=True,
             users_total=users_total,
             users_active=users_active,
             users_expired=users_expired,
             deliveries_total=deliveries_total,
-            deliveries_today=deliveries_today,
+            deliveries_today=today_row.deliveries if today_row else 0,
             last_delivery_at=str(last_delivery_at),
             payments_total_count=payments_total_count,
             revenue_mxn_total=revenue_mxn_total,
             revenue_mxn_30d=revenue_mxn_30d,
-            new_vip_today=new_vip_today,
-            expiring_today=expiring_today,
+            new_vip_today=today_row.payments if today_row else 0,  # pagos de hoy (como siempre)
+            new_vips_today=today_row.new_vips if today_row else 0,  # primer pago de ese chat
+            expiring_today=today_row.expirations if today_row else 0,
         ), 200
     except Exception as e:
         import traceback; traceback.print_exc()
+        recheck_schema_on(e)
         return jsonify(ok=False, error=str(e)), 500
 
 @app.get("/admin/metrics/revenue_by_day")
@@ -488,28 +2757,249 @@ def metrics_revenue_by_day():
 
         rows = []
         with SessionLocal() as db:
-            q = db.execute(
-                select(
-                    func.date(VIPPayment.approved_at).label("d"),
-                    func.coalesce(func.sum(VIPPayment.amount_mxn), 0).label("sum_mxn")
-                ).where(
-                    func.date(VIPPayment.approved_at) >= start
-                ).group_by(
-                    func.date(VIPPayment.approved_at)
-                ).order_by("d")
-            ).all()
-
-            map_by_day = {str(r.d): int(r.sum_mxn) for r in q if r.d}
+            map_by_day = dict(db.execute(
+                select(DailyStat.day, DailyStat.revenue_mxn).where(DailyStat.day >= start)
+            ).all())
             cur = start
             while cur <= today:
-                rows.append({"date": str(cur), "revenue_mxn": map_by_day.get(str(cur), 0)})
+                rows.append({"date": str(cur), "revenue_mxn": int(map_by_day.get(cur, 0))})
                 cur += timedelta(days=1)
 
         return jsonify(ok=True, days=rows), 200
     except Exception as e:
         import traceback; traceback.print_exc()
+        recheck_schema_on(e)
         return jsonify(ok=False, error=str(e)), 500
 
+@app.get("/admin/mp/inbox")
+def admin_mp_inbox():
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    try:
+        with SessionLocal() as db:
+            by_status = dict(db.execute(select(MPInbox.status, func.count(MPInbox.id)).group_by(MPInbox.status)).all())
+            oldest_pending = db.execute(
+                select(func.min(MPInbox.received_at)).where(MPInbox.status.in_(("pending", "processing", "failed")))
+            ).scalar_one_or_none()
+        with _mp_stats_lock:
+            stats = dict(MP_STATS)
+        timed = stats["applied"] + stats["skipped"]
+        stats["latency_avg"] = round(stats.pop("latency_sum") / timed, 3) if timed else 0.0
+        return jsonify(ok=True, queue_depth=mp_queue_depth(), by_status=by_status,
+                       oldest_pending=str(oldest_pending), worker=stats), 200
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        recheck_schema_on(e)
+        return jsonify(ok=False, error=str(e)), 500
+
+# Exportaciones: cada tabla con su SELECT, su clave de paginación (única y
+# ordenable) y la columna de fecha para filtrar con since/until.
+class ExportSpec(NamedTuple):
+    query: object
+    key: tuple
+    date_col: object
+
+EXPORTS = {
+    "users": ExportSpec(
+        select(VIPUser.id, VIPUser.chat_id, VIPUser.username, VIPUser.start_date, VIPUser.active_until,
+               VIPUser.last_sent_at, VIPUser.gallery_cursor),
+        (VIPUser.id,), VIPUser.start_date,
+    ),
+    "payments": ExportSpec(
+        select(VIPPayment.id, VIPPayment.chat_id, VIPPayment.mp_payment_id, VIPPayment.amount_mxn,
+               VIPPayment.currency, VIPPayment.status, VIPPayment.approved_at),
+        (VIPPayment.id,), VIPPayment.approved_at,
+    ),
+    "deliveries": ExportSpec(
+        select(VIPDelivery.chat_id, VIPDelivery.gallery_id, VIPGallery.url, VIPDelivery.sent_at)
+        .select_from(VIPDelivery).outerjoin(VIPGallery, VIPGallery.id == VIPDelivery.gallery_id),
+        (VIPDelivery.chat_id, VIPDelivery.gallery_id), VIPDelivery.sent_at,
+    ),
+}
+
+def keyset_after(cols: tuple, values: tuple):
+    """(a, b) > (x, y) escrito como a > x OR (a = x AND b > y), que usa el índice en cualquier DB."""
+    cond = cols[-1] > values[-1]
+    for col, value in zip(reversed(cols[:-1]), reversed(values[:-1])):
+        cond = or_(col > value, and_(col == value, cond))
+    return cond
+
+def export_rows(spec: ExportSpec, since: Optional[date], until: Optional[date], after: Optional[tuple],
+                limit: Optional[int] = None):
+    """Genera las filas página por página; cada página en su propia sesión corta.
+
+    Entre páginas no queda ninguna transacción abierta, así que un export largo
+    no bloquea al webhook ni retiene snapshots viejos en Postgres.
+    """
+    q = spec.query
+    if since:
+        q = q.where(spec.date_col >= since)
+    if until:
+        q = q.where(spec.date_col < until + timedelta(days=1))  # until inclusivo
+    q = q.order_by(*spec.key)
+    key_names = [c.key for c in spec.key]
+    sent = 0
+    while limit is None or sent < limit:
+        page = EXPORT_PAGE if limit is None else min(EXPORT_PAGE, limit - sent)
+        page_q = (q.where(keyset_after(spec.key, after)) if after else q).limit(page)
+        with SessionLocal() as db:
+            # En Postgres la página se lee con un cursor del servidor (sin doble buffer en
+            # psycopg2) y la sesión se cierra antes de mandar nada al cliente.
+            rows = db.execute(page_q.execution_options(stream_results=True, yield_per=500)).mappings().all()
+        yield from rows
+        if not rows:
+            return
+        sent += len(rows)
+        after = tuple(rows[-1][k] for k in key_names)
+        if len(rows) < page:
+            return
+
+def _export_value(v):
+    return v.isoformat() if isinstance(v, (date, datetime)) else v
+
+def export_ndjson(rows):
+    for row in rows:
+        yield json.dumps({k: _export_value(v) for k, v in row.items()}, ensure_ascii=False) + "\n"
+
+def export_csv(columns: list[str], rows):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        w.writerow([_export_value(v) for v in row.values()])
+        if i % 500 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+@app.get("/admin/export/<table>")
+def admin_export(table):
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    spec = EXPORTS.get(table)
+    if spec is None:
+        return jsonify(ok=False, error=f"unknown table, use one of: {', '.join(EXPORTS)}"), 404
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify(ok=False, error="format must be ndjson or csv"), 400
+    try:
+        since = date.fromisoformat(request.args["since"]) if request.args.get("since") else None
+        until = date.fromisoformat(request.args["until"]) if request.args.get("until") else None
+        # after=<clave de la última fila recibida> para continuar un export cortado
+        after = tuple(int(v) for v in request.args["after"].split(",")) if request.args.get("after") else None
+    except ValueError as e:
+        return jsonify(ok=False, error=str(e)), 400
+    if after and len(after) != len(spec.key):
+        return jsonify(ok=False, error=f"after needs {len(spec.key)} comma separated values"), 400
+    limit = request.args.get("limit", type=int)
+    ensure_schema_safe()
+
+    rows = export_rows(spec, since, until, after, limit)
+    if fmt == "csv":
+        body, mimetype = export_csv(list(spec.query.selected_columns.keys()), rows), "text/csv"
+    else:
+        body, mimetype = export_ndjson(rows), "application/x-ndjson"
+    filename = f"{table}-{day_mx().isoformat()}.{fmt}"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/admin/perf")
+def admin_perf():
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    merged = perf_merge(perf_collect())
+    if request.args.get("format") == "prometheus":
+        return Response(perf_prometheus(merged), mimetype="text/plain; version=0.0.4")
+    return jsonify(ok=True, **perf_json(merged)), 200
+
+# ======= CRON =======
+@app.route("/cron/daily_delivery", methods=["GET", "POST"])
+def cron_daily_delivery():
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    try:
+        max_seconds = request.args.get("max_seconds", default=DAILY_MAX_SECONDS, type=float)
+        result = run_daily_delivery(max_seconds=min(max_seconds, DAILY_MAX_SECONDS))
+        return jsonify(ok=True, **result), 200
+    except Exception as e:
+        traceback.print_exc()
+        recheck_schema_on(e)
+        notify_owner(f"🔥 Daily delivery failed:\n<pre>{esc(str(e))}</pre>")
+        return jsonify(ok=False, error=str(e)), 500
+
+@app.route("/cron/expiration_sweep", methods=["GET", "POST"])
+def cron_expiration_sweep():
+    if request.args.get("secret") != CRON_TOKEN:
+        return "forbidden", 403
+    ensure_schema_safe()
+    try:
+        max_seconds = request.args.get("max_seconds", default=DAILY_MAX_SECONDS, type=float)
+        result = run_expiration_sweep(
+            remind_days=request.args.get("days", default=EXPIRY_REMIND_DAYS, type=int),
+            archive_days=request.args.get("archive_days", default=EXPIRY_ARCHIVE_DAYS, type=int),
+            max_seconds=min(max_seconds, DAILY_MAX_SECONDS),
+        )
+        return jsonify(ok=True, **result), 200
+    except Exception as e:
+        traceback.print_exc()
+        recheck_schema_on(e)
+        notify_owner(f"🔥 Expiration sweep failed:\n<pre>{esc(str(e))}</pre>")
+        return jsonify(ok=False, error=str(e)), 500
+
+@app.cli.command("backfill-metrics")
+def backfill_metrics_command():
+    """Reconstruye vip_daily_stats desde las tablas históricas."""
+    ensure_schema_safe()
+    print(f"✅ vip_daily_stats rebuilt: {backfill_daily_stats()} days")
+
+@app.cli.command("migrate-deliveries")
+@click.option("--drop", is_flag=True, help="Borrar vip_deliveries al terminar.")
+def migrate_deliveries_command(drop):
+    """Pasa el historial de entregas al formato compacto (vip_delivery_log).
+
+    El arranque lo hace en segundo plano; correrlo antes del deploy evita que el
+    picker tenga que consultar también vip_deliveries mientras tanto.
+    """
+    ensure_schema_safe()
+    result = migrate_legacy_deliveries()
+    print(f"✅ deliveries migrated: {result}")
+    if drop and result["done"] and result["legacy_table"]:
+        legacy_deliveries.drop(engine)
+        print("🗑️ vip_deliveries dropped")
+
+@app.cli.command("poll")
+@click.option("--drain", is_flag=True, help="Terminar cuando no queden updates pendientes.")
+@click.option("--take-over", is_flag=True, help="Desactivar el webhook si está activo.")
+def poll_command(drain, take_over):
+    """Recibe updates con getUpdates en vez del webhook (no a la vez que él)."""
+    ensure_schema_safe()
+    url = (tg_webhook_info().get("result") or {}).get("url")
+    if url:
+        if not take_over:
+            raise click.ClickException(f"webhook is active ({url}); use --take-over to switch to polling")
+        info = tg_delete_webhook()
+        if not info.get("ok"):
+            raise click.ClickException(f"deleteWebhook failed: {info.get('description')}")
+    handled = run_poller(drain=drain)
+    tg_flush()
+    print(f"✅ drained {handled} updates")
+
+@app.cli.command("webhook")
+@click.argument("action", type=click.Choice(["on", "off", "info"]))
+@click.option("--drop-pending", is_flag=True, help="Con off: descartar los updates pendientes.")
+def webhook_command(action, drop_pending):
+    """Activa (on), desactiva (off) o muestra (info) el webhook de Telegram."""
+    if action == "on":
+        body = tg_set_webhook()
+    elif action == "off":
+        body = tg_delete_webhook(drop_pending=drop_pending)
+    else:
+        body = tg_webhook_info()
+    print(json.dumps(body, indent=2, ensure_ascii=False))
+
 # ========= MAIN =========
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
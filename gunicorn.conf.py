@@ -0,0 +1,26 @@
+# Configuración de gunicorn (Procfile: gunicorn bot:app -c gunicorn.conf.py).
+# WEB_THREADS también lo lee bot.py para dimensionar el pool de DB de cada worker.
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = 120
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+
+def post_fork(server, worker):
+    # Con preload, el engine se creó en el master: las conexiones heredadas por
+    # fork no se comparten, cada worker abre las suyas
+    bot = sys.modules.get("bot")
+    if bot is not None:
+        bot.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # El inbox de MP arranca con el worker, no con el primer aviso: si otro worker
+    # murió con pagos pendientes, MP ya recibió su 200 y puede no volver a avisar
+    bot = sys.modules.get("bot")
+    if bot is not None:
+        bot.mp_start_worker()
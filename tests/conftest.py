@@ -0,0 +1,85 @@
+"""Fixtures comunes: el bot contra SQLite y el stub de Telegram/Mercado Pago.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+
+Todo el tráfico saliente va a bench/stubs.py; los envíos a Telegram y el inbox
+de MP corren en el hilo del request (TG_SEND_MODE / MP_WEBHOOK_MODE = sync).
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+import stubs  # noqa: E402
+
+SECRET = "test"
+_tmp = tempfile.mkdtemp(prefix="puremuse-test-")
+_stub = stubs.serve(0)
+_stub_base = f"http://127.0.0.1:{_stub.server_address[1]}"
+with open(os.path.join(_tmp, "galleries.txt"), "w") as f:
+    f.write("\n".join(f"https://galleries.local/{i}" for i in range(10)) + "\n")
+
+# bot.py lee la configuración al importarse
+os.environ.update({
+    "DATABASE_URL": "sqlite:///" + os.path.join(_tmp, "bot.db"), "TOKEN": "test", "MP_ACCESS_TOKEN": "test",
+    "BASE_URL": "http://bot.local", "CRON_TOKEN": SECRET,
+    "TG_API_BASE": _stub_base, "MP_API_BASE": _stub_base, "TG_SEND_MODE": "sync", "MP_WEBHOOK_MODE": "sync",
+    "GALLERIES_PATH": os.path.join(_tmp, "galleries.txt"), "PERF_DIR": os.path.join(_tmp, "perf"),
+})
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(monkeypatch):
+    """Tablas vacías, cachés limpias y un stub sin historial en cada test."""
+    bot.Base.metadata.drop_all(bot.engine)
+    monkeypatch.setattr(bot, "_schema_ready", False)
+    monkeypatch.setattr(bot, "_gallery_synced_version", 0)
+    monkeypatch.setattr(bot, "recent_updates", bot.RecentIds(1000))
+    monkeypatch.setattr(bot, "start_data_bootstrap", lambda: None)  # migración y backfill: los llama cada test
+    bot.ensure_schema_safe()
+    bot.ensure_galleries_synced()
+    bot.vip_invalidate()
+    bot._mp_link_cache.clear()
+    handler = _stub.RequestHandlerClass
+    with handler.lock:
+        handler.counts.clear()
+        handler.updates.clear()
+        handler.webhook["url"] = ""
+    yield
+
+
+@pytest.fixture
+def client():
+    return bot.app.test_client()
+
+
+@pytest.fixture
+def stub():
+    """La clase handler del stub: .counts, .updates y .webhook."""
+    return _stub.RequestHandlerClass
+
+
+@pytest.fixture
+def make_vip():
+    def make(chat_id: int, days: int = 10):
+        now = bot.now_mx().replace(tzinfo=None)
+        with bot.SessionLocal() as db:
+            db.add(bot.VIPUser(chat_id=chat_id, start_date=now.date(), active_until=now + bot.timedelta(days=days)))
+            db.commit()
+    return make
+
+
+@pytest.fixture
+def rows():
+    """rows(Model, *where) → cuántas filas cumplen."""
+    def count(model, *where) -> int:
+        with bot.SessionLocal() as db:
+            return db.scalar(bot.select(bot.func.count()).select_from(model).where(*where))
+    return count
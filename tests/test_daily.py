@@ -0,0 +1,60 @@
+import bot
+
+
+def start_run():
+    today = bot.day_mx()
+    with bot.SessionLocal() as db:
+        run = bot.get_job_run(db, "daily_delivery", today.isoformat())
+        run_id = run.id
+        db.commit()
+    return run_id, today
+
+
+def test_daily_delivery_is_idempotent(stub, make_vip, rows):
+    for chat_id in range(1, 6):
+        make_vip(chat_id)
+    make_vip(9, days=-1)  # vencido: no recibe nada
+    first = bot.run_daily_delivery()
+    assert first["done"] and first["sent_now"] == 5
+    again = bot.run_daily_delivery()
+    assert again["sent_now"] == 0 and again["sent_total"] == 5
+    assert rows(bot.VIPDelivery) == 5
+    assert stub.counts["sendMessage"] == 5
+
+
+def test_daily_delivery_resumes_from_cursor(stub, make_vip, rows, monkeypatch):
+    monkeypatch.setattr(bot, "DAILY_CHUNK", 2)
+    for chat_id in range(1, 6):
+        make_vip(chat_id)
+    run_id, today = start_run()
+    # El cron se cortó después del primer lote
+    assert bot.deliver_daily_chunk(run_id, today) == (False, 2)
+    with bot.SessionLocal() as db:
+        cursor = db.get(bot.JobRun, run_id).cursor
+        first_ids = db.execute(bot.select(bot.VIPUser.id).order_by(bot.VIPUser.id).limit(2)).scalars().all()
+    assert cursor == first_ids[-1]
+
+    result = bot.run_daily_delivery()
+    assert result["done"] and result["sent_now"] == 3 and result["sent_total"] == 5
+    assert rows(bot.VIPDelivery) == 5
+    assert stub.counts["sendMessage"] == 5
+
+
+def test_cron_skips_chats_served_by_the_webhook(client, stub, make_vip, rows):
+    make_vip(1)
+    make_vip(2)
+    client.post("/telegram", json={"update_id": 1, "message": {"chat": {"id": 1}, "text": "Galleries"}})
+    assert bot.run_daily_delivery()["sent_now"] == 1
+    assert rows(bot.VIPDelivery, bot.VIPDelivery.chat_id == 1) == 1
+
+
+def test_already_sent_reply_repeats_todays_link(make_vip, monkeypatch):
+    # El cron guardó la entrega pero el mensaje encolado se perdió en un reinicio
+    make_vip(1)
+    monkeypatch.setattr(bot, "tg_send", lambda *a, **k: None)
+    bot.run_daily_delivery()
+    with bot.SessionLocal() as db:
+        url = bot.todays_gallery_url(db, 1)
+    assert url
+    reply = bot.cmd_galleries(1, None)
+    assert isinstance(reply, str) and url in reply
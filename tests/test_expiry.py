@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+import bot
+
+
+def reminded(chat_id: int):
+    with bot.SessionLocal() as db:
+        return db.execute(bot.select(bot.VIPUser.reminded_for).where(bot.VIPUser.chat_id == chat_id)).scalar_one()
+
+
+def test_reminder_is_sent_once_per_paid_period(stub, make_vip):
+    make_vip(1, days=2)
+    make_vip(2, days=20)  # fuera de la ventana
+    assert bot.run_expiration_sweep()["reminders"] == 1
+    assert bot.run_expiration_sweep()["reminders"] == 0
+    assert stub.counts["sendMessage"] == 1
+
+    # Renovó: el siguiente periodo vuelve a tener recordatorio
+    with bot.SessionLocal() as db:
+        u = db.execute(bot.select(bot.VIPUser).where(bot.VIPUser.chat_id == 1)).scalar_one()
+        u.active_until += timedelta(days=1)
+        db.commit()
+    assert bot.run_expiration_sweep()["reminders"] == 1
+
+
+def test_failed_reminder_is_retried_next_sweep(make_vip, monkeypatch):
+    make_vip(1, days=2)
+    make_vip(2, days=2)
+    monkeypatch.setattr(bot, "tg_send_now", lambda chat_id, text: chat_id != 2)
+    first = bot.run_expiration_sweep()
+    marked = [reminded(1), reminded(2)]
+    assert first["reminders"] == sum(m is not None for m in marked)
+    assert marked[1] is None  # no salió: queda pendiente
+
+    monkeypatch.setattr(bot, "tg_send_now", lambda chat_id, text: True)
+    bot.run_expiration_sweep()
+    assert reminded(1) is not None and reminded(2) is not None
@@ -0,0 +1,129 @@
+import pytest
+from sqlalchemy import event
+
+import bot
+
+URLS = [f"https://galleries.local/{i}" for i in range(10)]
+GONE = "https://galleries.local/removed"  # ya no está en galleries.txt
+
+
+@pytest.fixture
+def legacy():
+    """Crea vip_deliveries (formato viejo); legacy(chat_id, url, ...) agrega filas."""
+    bot.legacy_metadata.create_all(bot.engine)
+    now = bot.now_mx().replace(tzinfo=None)
+
+    def add(*deliveries):
+        with bot.engine.begin() as conn:
+            conn.execute(bot.insert(bot.legacy_deliveries), [
+                {"chat_id": c, "gallery_hash": bot.url_hash(u), "url": u, "sent_at": now} for c, u in deliveries
+            ])
+    yield add
+    bot.legacy_metadata.drop_all(bot.engine)
+
+
+def delivered(chat_id: int) -> set:
+    with bot.SessionLocal() as db:
+        return set(db.execute(
+            bot.select(bot.VIPGallery.url).join(bot.VIPDelivery, bot.VIPDelivery.gallery_id == bot.VIPGallery.id)
+            .where(bot.VIPDelivery.chat_id == chat_id)
+        ).scalars())
+
+
+def test_copies_duplicates_once(legacy, rows):
+    legacy((1, URLS[0]), (1, URLS[0]), (1, URLS[1]), (2, URLS[0]))
+    result = bot.migrate_legacy_deliveries()
+    assert result["done"] and result["copied"] == 3
+    assert delivered(1) == {URLS[0], URLS[1]} and delivered(2) == {URLS[0]}
+    assert rows(bot.VIPDelivery) == 3
+
+
+def test_removed_urls_are_kept_out_of_rotation(legacy, rows):
+    legacy((1, GONE))
+    assert bot.migrate_legacy_deliveries()["copied"] == 1
+    assert delivered(1) == {GONE}
+    assert rows(bot.VIPGallery, bot.VIPGallery.url == GONE, bot.VIPGallery.position == -1) == 1
+    with bot.SessionLocal() as db:
+        assert bot.pick_vip_gallery(db, 1).url == URLS[1]
+
+
+def test_resumes_after_a_cut_off_chunk(legacy, rows):
+    legacy(*[(c, URLS[c % 3 + 1]) for c in range(1, 6)])
+
+    calls = {"n": 0}
+
+    def cut(conn, cursor, statement, *args):
+        if statement.startswith("INSERT INTO vip_delivery_log"):
+            calls["n"] += 1
+            if calls["n"] == 2:
+                raise RuntimeError("worker killed")
+
+    event.listen(bot.engine, "before_cursor_execute", cut)
+    try:
+        with pytest.raises(RuntimeError):
+            bot.migrate_legacy_deliveries(chunk=2)
+    finally:
+        event.remove(bot.engine, "before_cursor_execute", cut)
+    # El primer lote quedó confirmado; el segundo se deshizo entero
+    assert rows(bot.VIPDelivery) == 2
+    with bot.SessionLocal() as db:
+        run = bot.get_job_run(db, "migrate_deliveries", "v1")
+        assert (run.cursor, run.processed, run.status) == (2, 2, "running")
+
+    result = bot.migrate_legacy_deliveries(chunk=2)
+    assert result["done"] and result["copied"] == 3 and result["copied_total"] == 5
+    assert rows(bot.VIPDelivery) == 5
+
+
+def test_second_run_copies_nothing(legacy, rows):
+    legacy((1, URLS[0]), (2, URLS[1]))
+    assert bot.migrate_legacy_deliveries()["copied"] == 2
+    again = bot.migrate_legacy_deliveries()
+    assert again["done"] and again["copied"] == 0 and again["copied_total"] == 2
+    assert rows(bot.VIPDelivery) == 2
+
+
+def test_picker_skips_legacy_history_until_migrated(legacy, monkeypatch):
+    monkeypatch.setattr(bot, "_legacy_deliveries_pending", False)
+    legacy((1, URLS[1]))
+    bot.ensure_schema_safe(force=True)
+    assert bot._legacy_deliveries_pending
+    with bot.SessionLocal() as db:
+        assert bot.pick_vip_gallery(db, 1, cursor=0).url == URLS[2]
+    bot.migrate_legacy_deliveries()
+    assert not bot._legacy_deliveries_pending
+    with bot.SessionLocal() as db:
+        assert bot.pick_vip_gallery(db, 1, cursor=0).url == URLS[2]
+
+
+def daily_deliveries() -> int:
+    with bot.SessionLocal() as db:
+        return db.scalar(bot.select(bot.func.coalesce(bot.func.sum(bot.DailyStat.deliveries), 0)))
+
+
+def test_migrated_deliveries_are_backfilled_once(legacy):
+    legacy((1, URLS[0]), (2, URLS[1]), (3, GONE))
+    bot.migrate_legacy_deliveries()
+    assert daily_deliveries() == 0  # la copia no pasa por bump_daily
+    assert bot.bootstrap_daily_stats() == 1
+    assert daily_deliveries() == 3
+    with bot.SessionLocal() as db:
+        bot.bump_daily(db, bot.day_mx(), deliveries=1)
+        db.commit()
+    assert bot.bootstrap_daily_stats() is None  # ya hecho: no pisa lo que sumó el bot
+    assert daily_deliveries() == 4
+
+
+def test_backfill_skips_a_populated_rollup_without_migration(make_vip):
+    make_vip(1)
+    with bot.SessionLocal() as db:
+        bot.bump_daily(db, bot.day_mx(), deliveries=2)
+        db.commit()
+    assert bot.bootstrap_daily_stats() is None
+    assert daily_deliveries() == 2
+
+
+def test_backfill_fills_an_empty_rollup(make_vip, rows):
+    make_vip(1)
+    assert bot.bootstrap_daily_stats() == 1
+    assert rows(bot.DailyStat, bot.DailyStat.expirations == 1) == 1
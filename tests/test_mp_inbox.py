@@ -0,0 +1,98 @@
+import os
+import runpy
+import threading
+import time
+from datetime import timedelta
+
+import bot
+from conftest import SECRET
+
+URL = f"/mp/webhook?secret={SECRET}"
+
+
+def notify(client, pid: str):
+    return client.post(URL, json={"type": "payment", "action": "payment.updated", "data": {"id": pid}})
+
+
+def add_stale_pending(pid: str, minutes: int = 2):
+    """Fila que un worker anotó y no llegó a aplicar (murió entre medio)."""
+    old = bot.now_mx().replace(tzinfo=None) - timedelta(minutes=minutes)
+    with bot.SessionLocal() as db:
+        db.add(bot.MPInbox(mp_payment_id=pid, status="pending", attempts=0, received_at=old, updated_at=old))
+        db.commit()
+
+
+def test_payment_activates_vip(client, stub, rows):
+    assert notify(client, "41").status_code == 200
+    assert rows(bot.VIPPayment, bot.VIPPayment.mp_payment_id == "41") == 1
+    assert bot.vip_lookup(42) is not None  # el stub usa external_reference = id % 100000 + 1
+    assert stub.counts["payments"] == 1
+
+
+def test_repeated_notifications_apply_once(client, stub, rows):
+    for _ in range(3):
+        assert notify(client, "41").status_code == 200
+    assert rows(bot.VIPPayment) == 1
+    assert rows(bot.MPInbox, bot.MPInbox.status == "done") == 1
+    assert stub.counts["payments"] == 1  # los repetidos ni siquiera consultan a MP
+
+
+def test_concurrent_notifications_apply_once(rows):
+    def post():
+        notify(bot.app.test_client(), "41")
+    threads = [threading.Thread(target=post) for _ in range(6)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert rows(bot.VIPPayment) == 1
+    with bot.SessionLocal() as db:
+        u = db.execute(bot.select(bot.VIPUser).where(bot.VIPUser.chat_id == 42)).scalar_one()
+    assert (u.active_until.date() - u.start_date).days == 30  # extendido una sola vez
+
+
+def test_retried_notification_after_apply_is_a_duplicate(client, rows):
+    notify(client, "41")
+    bot.process_mp_notification("41")  # p. ej. otro worker con el mismo aviso en cola
+    assert rows(bot.VIPPayment) == 1
+
+
+def test_fresh_pending_retry_is_not_requeued(client, stub, rows):
+    add_stale_pending("41", minutes=0)
+    notify(client, "41")
+    assert rows(bot.VIPPayment) == 0
+    assert "payments" not in stub.counts
+
+
+def test_stale_pending_row_recovered_by_retry(client, rows):
+    add_stale_pending("41")
+    for _ in range(3):
+        assert notify(client, "41").status_code == 200
+    assert rows(bot.VIPPayment) == 1
+    assert rows(bot.MPInbox, bot.MPInbox.status == "done") == 1
+    assert bot.vip_lookup(42) is not None
+
+
+def test_stale_pending_row_recovered_by_worker_scan(client, rows, monkeypatch):
+    # Modo async: el hilo del inbox arranca con cualquier aviso y su primer pase
+    # recoge la fila huérfana, aunque el aviso que llega sea de otro pago
+    monkeypatch.setattr(bot, "MP_WEBHOOK_MODE", "async")
+    monkeypatch.setattr(bot, "_mp_worker_pid", None)
+    add_stale_pending("41")
+    notify(client, "77")
+    deadline = time.monotonic() + 10
+    while rows(bot.MPInbox, bot.MPInbox.status == "done") < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert rows(bot.VIPPayment, bot.VIPPayment.mp_payment_id == "41") == 1
+    assert rows(bot.VIPPayment, bot.VIPPayment.mp_payment_id == "77") == 1
+
+
+def test_worker_started_at_boot_recovers_without_notifications(rows, monkeypatch):
+    # Ningún aviso nuevo llega: basta con que el worker de gunicorn arranque
+    monkeypatch.setattr(bot, "MP_WEBHOOK_MODE", "async")
+    monkeypatch.setattr(bot, "_mp_worker_pid", None)
+    add_stale_pending("41")
+    conf = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py"))
+    conf["post_worker_init"](None)
+    deadline = time.monotonic() + 10
+    while rows(bot.VIPPayment) < 1 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert rows(bot.VIPPayment, bot.VIPPayment.mp_payment_id == "41") == 1
@@ -0,0 +1,53 @@
+import bot
+
+
+def batch(first_id: int, n: int, text: str = "Galleries") -> list[dict]:
+    return [{"update_id": first_id + i, "message": {"message_id": i + 1, "chat": {"id": 100 + i}, "text": text}}
+            for i in range(n)]
+
+
+def stored_offset() -> int:
+    with bot.SessionLocal() as db:
+        return int(bot.get_state(db, bot.TG_OFFSET_KEY) or 0)
+
+
+def test_poller_handles_batch_and_stores_offset(stub, make_vip, rows):
+    for i in range(5):
+        make_vip(100 + i)
+    stub.updates.extend(batch(1, 5))
+    assert bot.run_poller(drain=True) == 5
+    assert stored_offset() == 6
+    assert rows(bot.VIPDelivery) == 5
+    assert stub.counts["sendMessage"] == 5
+
+
+def test_batch_replayed_after_crash_is_skipped(stub, make_vip, rows, monkeypatch):
+    for i in range(5):
+        make_vip(100 + i)
+    updates = batch(1, 5) + batch(6, 5, "VIP status")
+    stub.updates.extend(updates)
+    bot.run_poller(drain=True)
+    sent = stub.counts["sendMessage"]
+
+    # El worker murió antes de guardar el offset: el proceso nuevo recibe el mismo lote
+    with bot.SessionLocal() as db:
+        bot.set_state(db, bot.TG_OFFSET_KEY, "0")
+        db.commit()
+    monkeypatch.setattr(bot, "recent_updates", bot.RecentIds(1000))
+    stub.updates.extend(updates)
+    assert bot.run_poller(drain=True) == 10
+    assert rows(bot.VIPDelivery) == 5
+    assert stub.counts["sendMessage"] == sent
+    assert stored_offset() == 11
+
+
+def test_poll_refuses_to_replace_an_active_webhook(stub):
+    bot.tg_set_webhook()
+    runner = bot.app.test_cli_runner()
+    result = runner.invoke(args=["poll", "--drain"])
+    assert result.exit_code != 0 and "--take-over" in result.output
+    assert stub.webhook["url"] == "http://bot.local/telegram"
+
+    result = runner.invoke(args=["poll", "--drain", "--take-over"])
+    assert result.exit_code == 0
+    assert stub.webhook["url"] == ""
@@ -0,0 +1,150 @@
+import pytest
+
+import bot
+from conftest import SECRET
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(bot, "PURGE_CHUNK", 2)
+    monkeypatch.setattr(bot, "PURGE_PAUSE_SECS", 0)
+    # Los endpoints corren el job en el hilo del request
+    monkeypatch.setattr(bot, "start_purge", lambda run_id: bot.run_purge(run_id) or True)
+
+
+def status(run_id: int) -> dict:
+    with bot.SessionLocal() as db:
+        return bot.purge_status(db.get(bot.JobRun, run_id))
+
+
+def add_payment(chat_id: int, mp_id: str):
+    with bot.SessionLocal() as db:
+        db.add(bot.VIPPayment(chat_id=chat_id, mp_payment_id=mp_id, amount_mxn=50, status="approved",
+                              approved_at=bot.now_mx().replace(tzinfo=None)))
+        db.commit()
+
+
+def deliver(chat_id: int):
+    with bot.SessionLocal() as db:
+        bot.record_delivery(db, chat_id, bot.pick_vip_gallery(db, chat_id).id)
+        db.commit()
+
+
+def test_purge_runs_in_chunks(make_vip, rows, monkeypatch):
+    for chat_id in range(1, 6):
+        make_vip(chat_id)
+        deliver(chat_id)
+    batches = []
+    purge_batch = bot._purge_batch
+
+    def counted(db, table, chat_id):
+        n, chats = purge_batch(db, table, chat_id)
+        batches.append((table, n))
+        return n, chats
+
+    monkeypatch.setattr(bot, "_purge_batch", counted)
+    run_id = bot.create_purge()
+    bot.run_purge(run_id)
+    assert [b for b in batches if b[1]] == [("deliveries", 2), ("deliveries", 2), ("deliveries", 1),
+                                             ("users", 2), ("users", 2), ("users", 1)]
+    st = status(run_id)
+    assert st["status"] == "done" and st["deleted_total"] == 10
+    assert st["deleted"] == {"deliveries": 5, "archive": 0, "users": 5}
+    assert rows(bot.VIPUser) == rows(bot.VIPDelivery) == 0
+
+
+def test_cancel_stops_between_batches_and_resume_finishes(client, make_vip, rows, monkeypatch):
+    for chat_id in range(1, 6):
+        make_vip(chat_id)
+    run_id = bot.create_purge()
+    invalidate = bot.vip_invalidate
+    cancels = []
+
+    def cancel_after_first_batch(chat_id=None):
+        invalidate(chat_id)
+        if rows(bot.VIPUser) == 3 and not cancels:
+            cancels.append(chat_id)
+            r = client.post(f"/admin/purge/{run_id}/cancel?secret={SECRET}")
+            assert r.status_code == 200 and r.get_json()["status"] == "cancelled"
+
+    monkeypatch.setattr(bot, "vip_invalidate", cancel_after_first_batch)
+    bot.run_purge(run_id)
+    assert status(run_id)["status"] == "cancelled"
+    assert rows(bot.VIPUser) == 3
+
+    r = client.post(f"/admin/purge/{run_id}/resume?secret={SECRET}")
+    assert r.status_code == 202
+    st = client.get(f"/admin/purge/{run_id}?secret={SECRET}").get_json()
+    assert st["status"] == "done" and st["deleted"]["users"] == 5
+    assert rows(bot.VIPUser) == 0
+    # Ya terminado: ni cancelar ni reanudar
+    assert client.post(f"/admin/purge/{run_id}/cancel?secret={SECRET}").status_code == 409
+    assert client.post(f"/admin/purge/{run_id}/resume?secret={SECRET}").status_code == 409
+
+
+def test_failed_purge_resumes_where_it_stopped(client, make_vip, rows, monkeypatch):
+    for chat_id in range(1, 6):
+        make_vip(chat_id)
+    told = []
+    monkeypatch.setattr(bot, "notify_owner", told.append)
+    purge_batch = bot._purge_batch
+    calls = {"users": 0}
+
+    def flaky(db, table, chat_id):
+        if table == "users":
+            calls["users"] += 1
+            if calls["users"] == 2:
+                raise RuntimeError("connection reset")
+        return purge_batch(db, table, chat_id)
+
+    monkeypatch.setattr(bot, "_purge_batch", flaky)
+    run_id = bot.create_purge()
+    bot.run_purge(run_id)
+    st = status(run_id)
+    assert st["status"] == "failed" and st["deleted"]["users"] == 2 and st["table"] == "users"
+    assert [t for t in told if t.startswith(f"🔥 Purge job {run_id} failed (resume with /admin/purge/{run_id}/resume)")]
+
+    assert client.post(f"/admin/purge/{run_id}/resume?secret={SECRET}").status_code == 202
+    st = status(run_id)
+    assert st["status"] == "done" and st["deleted"]["users"] == 5
+    assert rows(bot.VIPUser) == 0
+
+
+def test_payments_are_kept_unless_asked(make_vip, rows):
+    make_vip(1)
+    add_payment(1, "p1")
+    make_vip(2)
+    add_payment(2, "p2")
+    bot.run_purge(bot.create_purge(chat_id=1))
+    assert rows(bot.VIPUser) == 1 and rows(bot.VIPPayment) == 2
+
+    run_id = bot.create_purge(chat_id=1, payments=True)
+    bot.run_purge(run_id)
+    assert status(run_id)["deleted"]["payments"] == 1
+    assert rows(bot.VIPPayment, bot.VIPPayment.chat_id == 1) == 0
+    assert rows(bot.VIPPayment, bot.VIPPayment.chat_id == 2) == 1
+
+
+def test_purging_users_takes_back_their_future_expirations(make_vip, rows):
+    make_vip(1, days=10)
+    make_vip(2, days=10)
+    make_vip(3, days=-3)  # ya venció: su día queda igual
+    bot.backfill_daily_stats()
+    future = (bot.now_mx() + bot.timedelta(days=10)).date()
+    past = (bot.now_mx() - bot.timedelta(days=3)).date()
+    assert rows(bot.DailyStat, bot.DailyStat.day == future, bot.DailyStat.expirations == 2) == 1
+
+    bot.run_purge(bot.create_purge(chat_id=1))
+    assert rows(bot.DailyStat, bot.DailyStat.day == future, bot.DailyStat.expirations == 1) == 1
+    bot.run_purge(bot.create_purge(chat_id=3))
+    assert rows(bot.DailyStat, bot.DailyStat.day == past, bot.DailyStat.expirations == 1) == 1
+
+
+def test_clear_all_needs_a_post(client, make_vip, rows):
+    make_vip(1)
+    assert client.get(f"/admin/clear_all?secret={SECRET}").status_code == 405
+    assert rows(bot.VIPUser) == 1
+    r = client.post(f"/admin/clear_all?secret={SECRET}")
+    assert r.status_code == 202
+    assert status(r.get_json()["job_id"])["status"] == "done"
+    assert rows(bot.VIPUser) == 0
@@ -0,0 +1,44 @@
+import json
+import threading
+import time
+
+import bot
+
+
+def test_busy_chat_does_not_stall_its_shard(monkeypatch):
+    sent = []
+    lock = threading.Lock()
+
+    def record(chat_id, body, have_token=False):
+        with lock:
+            sent.append((chat_id, time.monotonic(), json.loads(body)["text"]))
+
+    monkeypatch.setattr(bot, "TG_SEND_MODE", "async")
+    monkeypatch.setattr(bot, "TG_CHAT_RATE", 4.0)
+    monkeypatch.setattr(bot, "TG_CHAT_BURST", 1)
+    monkeypatch.setattr(bot, "_tg_chat_buckets", {})
+    monkeypatch.setattr(bot, "_tg_post", record)
+
+    shards = len(bot._tg_queues) or bot.TG_SEND_WORKERS
+    busy, quiet = 4, 4 + shards  # mismo shard
+    t0 = time.monotonic()
+    for i in range(6):
+        bot.tg_send(busy, f"busy {i}")
+    bot.tg_send(quiet, "hello")
+    bot.tg_flush()
+
+    busy_sent = [(t, text) for c, t, text in sent if c == busy]
+    quiet_time = next(t for c, t, _ in sent if c == quiet)
+    assert [text for _, text in busy_sent] == [f"busy {i}" for i in range(6)]  # en orden
+    assert busy_sent[-1][0] - t0 >= 1.0  # el chat ocupado respeta su límite
+    assert quiet_time - t0 < 0.5         # y el otro chat del shard no lo espera
+
+
+def test_bucket_eviction_keeps_active_chats(monkeypatch):
+    buckets = {i: bot.TokenBucket(1, 3) for i in range(10001)}
+    active = buckets[5] = bot.TokenBucket(1, 3)
+    active.reserve()
+    monkeypatch.setattr(bot, "_tg_chat_buckets", buckets)
+    bot._tg_chat_bucket(99999)
+    assert buckets.get(5) is active
+    assert len(buckets) == 2
@@ -0,0 +1,79 @@
+import json
+
+import bot
+
+
+def update(update_id: int, chat_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": text}}
+
+
+def test_static_reply_goes_back_in_the_webhook_response(client, stub):
+    r = client.post("/telegram", json=update(1, 10, "/start"))
+    body = json.loads(r.data)
+    assert body["method"] == "sendMessage" and body["chat_id"] == 10
+    assert "sendMessage" not in stub.counts
+
+
+def test_dynamic_reply_is_sent_through_the_api(client, stub, make_vip):
+    make_vip(10)
+    r = client.post("/telegram", json=update(1, 10, "VIP status"))
+    assert json.loads(r.data) == {"ok": True}
+    assert stub.counts["sendMessage"] == 1
+
+
+def test_duplicate_update_id_is_dropped(client, stub, make_vip, rows):
+    make_vip(20)
+    upd = update(7, 20, "Galleries")
+    for _ in range(3):
+        assert client.post("/telegram", json=upd).status_code == 200
+    assert rows(bot.VIPDelivery) == 1
+    assert stub.counts["sendMessage"] == 1
+
+    # El reintento llega a otro worker (sin la ventana en memoria): lo frena tg_updates
+    bot.recent_updates.discard(7)
+    client.post("/telegram", json=upd)
+    assert rows(bot.VIPDelivery) == 1
+    assert stub.counts["sendMessage"] == 1
+
+
+def test_static_duplicate_is_answered_once(client):
+    first = client.post("/telegram", json=update(3, 10, "/start"))
+    again = client.post("/telegram", json=update(3, 10, "/start"))
+    assert json.loads(first.data)["method"] == "sendMessage"
+    assert json.loads(again.data) == {"ok": True}
+
+
+def test_owner_is_told_even_if_release_fails(client, make_vip, monkeypatch):
+    make_vip(30)
+    told, rechecked = [], []
+
+    def crash(*a, **k):
+        raise RuntimeError("handler down")
+
+    def release_fails(update_id):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(bot, "deliver_vip_gallery", crash)
+    monkeypatch.setattr(bot, "release_update", release_fails)
+    monkeypatch.setattr(bot, "notify_owner", told.append)
+    monkeypatch.setattr(bot, "recheck_schema_on", rechecked.append)
+    assert client.post("/telegram", json=update(9, 30, "Galleries")).status_code == 200
+    assert len(told) == 1 and "handler down" in told[0]
+    assert len(rechecked) == 1
+
+
+def test_webhook_prunes_old_updates(client, rows, monkeypatch):
+    old = bot.now_mx().replace(tzinfo=None) - bot.timedelta(days=bot.TG_DEDUPE_DAYS + 1)
+    with bot.SessionLocal() as db:
+        db.add(bot.ProcessedUpdate(update_id=1, received_at=old))
+        db.commit()
+    monkeypatch.setattr(bot, "_updates_pruned_at", 0.0)
+    client.post("/telegram", json=update(2, 10, "/start"))
+    assert rows(bot.ProcessedUpdate, bot.ProcessedUpdate.update_id == 1) == 0
+
+    # Hasta dentro de TG_DEDUPE_PRUNE_SECS no vuelve a consultar
+    with bot.SessionLocal() as db:
+        db.add(bot.ProcessedUpdate(update_id=3, received_at=old))
+        db.commit()
+    client.post("/telegram", json=update(4, 10, "/start"))
+    assert rows(bot.ProcessedUpdate, bot.ProcessedUpdate.update_id == 3) == 1